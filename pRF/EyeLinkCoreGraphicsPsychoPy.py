@@ -30,8 +30,8 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import sys
 import platform
-import array
 import string
 import pylink
 import numpy
@@ -40,7 +40,7 @@ from psychopy import visual, event, core, logging, prefs, monitors
 from psychopy.tools.coordinatetools import pol2cart
 from psychopy.hardware import keyboard
 from math import sin, cos, pi
-from PIL import Image, ImageDraw
+from PIL import Image
 from psychopy.sound import Sound
 
 
@@ -53,6 +53,34 @@ DISABLE_AUDIO=True
 logging.console.setLevel(logging.CRITICAL)
 
 
+def _build_key_map():
+    """ Map psychopy key names to the key codes pylink expects, looked up
+    once per key press in get_input_key"""
+
+    key_map = {'f1': pylink.F1_KEY, 'f2': pylink.F2_KEY, 'f3': pylink.F3_KEY,
+               'f4': pylink.F4_KEY, 'f5': pylink.F5_KEY, 'f6': pylink.F6_KEY,
+               'f7': pylink.F7_KEY, 'f8': pylink.F8_KEY, 'f9': pylink.F9_KEY,
+               'f10': pylink.F10_KEY,
+               'pageup': pylink.PAGE_UP, 'pagedown': pylink.PAGE_DOWN,
+               'up': pylink.CURS_UP, 'down': pylink.CURS_DOWN,
+               'left': pylink.CURS_LEFT, 'right': pylink.CURS_RIGHT,
+               'backspace': ord('\b'), 'return': pylink.ENTER_KEY,
+               'space': ord(' '), 'escape': 27, 'tab': ord('\t'),
+               # Plus/equal & minux signs for CR adjustment
+               'num_add': ord('+'), 'equal': ord('+'),
+               'num_subtract': ord('-'), 'minus': ord('-')}
+    for letter in string.ascii_letters:
+        key_map[letter] = ord(letter)
+    return key_map
+
+
+KEY_MAP = _build_key_map()
+# modifier keys and the modifier code they add, in order of precedence
+MODIFIER_CODES = ((('lalt', 'ralt'), 256), (('lctrl', 'rctrl'), 64),
+                  (('lshift', 'rshift'), 1))
+MODIFIER_KEYS = set(name for names, _ in MODIFIER_CODES for name in names)
+
+
 class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
     def __init__(self, tracker, win):
 
@@ -86,8 +114,10 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
             self._display.setUnits('pix')
 
         # Camera image set up
-        self._imagebuffer = array.array('I')
-        self._pal = None  # color pallete to use for camera image drawing
+        self._imagebuffer = None  # (totlines, width) uint32, packed RGBX
+        self._overlayScale = (2.0, 2.0)  # crosshair coords -> image pixels
+        self._overlayColors = {}  # colorindex -> packed RGBX
+        self._pal = None  # uint32 color LUT to use for camera image drawing
         self._size = (384, 320)
 
         # Initial setup for the mouse
@@ -96,8 +126,16 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
 
         # Initial setup for the keyboard
         self._kb = keyboard.Keyboard()
-        self._modifiers = {'lalt':False,'ralt':False,'lctrl':False,'rctrl':False,'lshift':False,'rshift':False}
-        self._keyPressNameList = list()
+        # key presses already handed to pylink that are still in the
+        # keyboard buffer, as (name, tDown); getKeys returns new copies of
+        # the presses on every call, so they are matched by value
+        self._keysDown = set()
+        self._modifiersHeld = set()
+        # PsychoPy up to 2023 sets duration on the presses of a
+        # waitRelease=False drain once the key is up, so releases are only
+        # cleared from the buffer when one is seen; later keyboards do not
+        # return released keys there, and need a release drain every poll
+        self._drainReleases = int(psychopy.__version__.split('.')[0]) >= 2024
 
         # Image title & calibration instructions
         self._msgHeight = self._size[1]/16.0
@@ -161,6 +199,12 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
         self._animatedTarget = False
         self._movieTarget = None
         self._pictureTarget = None
+        # configuration the current target stimuli were built for
+        self._calTargetKey = None
+
+        # The beep currently playing, and when it will have finished
+        self._beep = None
+        self._beepEndTime = 0.0
 
         # Configure calibration sounds (beeps), use ".wav" files
         if not DISABLE_AUDIO:
@@ -181,7 +225,13 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
 
         # The tracker is running in mouse simulation mode?
         self._mouse_simulation = False
-        self.imgResize = None
+        # time the pending 'aux_mouse_simulation' request was sent, or None
+        self._mouseSimRequestTime = None
+        # callback profiler, set by enableProfiling()
+        self._profiler = None
+        # One camera image stim kept alive across frames; its texture is
+        # updated in place and the GPU does the x2 scaling
+        self._camImage = None
 
     def __str__(self):
         """ Overwrite __str__ to show some information about the
@@ -291,9 +341,30 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
         else:
             self._error_beep.setSound(error_beep)
 
+    def _cal_target_key(self):
+        """ Everything the calibration target stimuli are built from"""
+
+        def hashable(color):
+            if isinstance(color, str):
+                return color
+            return tuple(numpy.ravel(color).tolist())
+
+        return (self._calTarget, self._targetSize,
+                hashable(self._foregroundColor),
+                hashable(self._backgroundColor),
+                self._pictureTarget, self._movieTarget)
+
     def update_cal_target(self):
         """ Make sure target stimuli is already memory when
-            being used by draw_cal_target """ 
+            being used by draw_cal_target
+
+        The stimuli are only rebuilt when the target configuration changed
+        since they were last built (see the set* methods)""" 
+
+        key = self._cal_target_key()
+        if key == self._calTargetKey:
+            return
+        self._calTargetKey = key
 
         if self._calTarget == 'picture':
             if self._pictureTarget is None:
@@ -349,6 +420,35 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
                                                 color=self._backgroundColor,
                                                 units='pix')
 
+    def prewarmCalTarget(self):
+        """ Build the calibration target and draw it once off-screen, so
+        textures are on the GPU before the first calibration """
+
+        self.update_cal_target()
+        if self._calTarget == 'circle':
+            self._tarOuter.draw()
+            self._tarInner.draw()
+        elif self._calTarget in ['picture', 'spiral']:
+            self._calibTar.draw()
+        self._display.clearBuffer()
+
+    def enableProfiling(self, report=print):
+        """ Record call counts, wall time and flips of every pylink
+        callback (see cal_profiler.py); the summary table is passed to
+        report whenever the calibration display is exited
+
+        Returns:
+            the CallbackProfiler, e.g. for profiler.summary()
+        """
+        from cal_profiler import CallbackProfiler
+
+        if self._profiler is None:
+            self._profiler = CallbackProfiler()
+            self._profiler.attach(self, self._display,
+                                  report_after='exit_cal_display',
+                                  report=report)
+        return self._profiler
+
     def setup_cal_display(self):
         """ Set up the calibration display before entering
         the calibration/validation routine""" 
@@ -440,7 +540,11 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
             self._display.flip()
         
     def play_beep(self, beepid):
-        """ Play a sound during calibration/drift correct.""" 
+        """ Play a sound during calibration/drift correct.
+
+        The sound plays asynchronously; instead of waiting for it, the beep
+        is marked as in progress until it has finished, so pylink keeps
+        polling get_input_key and animated targets keep moving.""" 
 
         global DISABLE_AUDIO
         # if sound is disabled, don't play
@@ -451,20 +555,33 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
                 pass
             else:
                 if beepid in [pylink.CAL_TARG_BEEP, pylink.DC_TARG_BEEP]:
-                    if self._target_beep is not None:
-                        self._target_beep.play()
-                        core.wait(0.5)
+                    self._start_beep(self._target_beep, 0.5)
                 elif beepid in [pylink.CAL_ERR_BEEP, pylink.DC_ERR_BEEP]:
-                    if self._error_beep is not None:
-                        self._error_beep.play()
-                        core.wait(1.2)
+                    self._start_beep(self._error_beep, 1.2)
                 elif beepid in [pylink.CAL_GOOD_BEEP, pylink.DC_GOOD_BEEP]:
-                    if self._done_beep is not None:
-                        self._done_beep.play()
-                        core.wait(0.5)
+                    self._start_beep(self._done_beep, 0.5)
                 else:
                     pass
 
+    def _start_beep(self, beep, duration):
+        """ Start a preloaded beep without blocking; a beep still in
+        progress is cut short"""
+
+        if beep is None:
+            return
+        if self.beepInProgress():
+            self._beep.stop()
+        beep.play()
+        self._beep = beep
+        self._beepEndTime = core.getTime() + duration
+
+    def beepInProgress(self):
+        """ Whether a calibration beep is still playing """
+
+        if self._beep is not None and core.getTime() >= self._beepEndTime:
+            self._beep = None
+        return self._beep is not None
+
     def getColorFromIndex(self, colorindex):
         """ Return psychopy colors for elements in the camera image""" 
 
@@ -481,21 +598,56 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
         else:
             return (128, 128, 128)
 
+    def _overlay_color(self, colorindex):
+        """ Packed RGBX value of an overlay color, as in the palette LUT"""
+
+        if colorindex not in self._overlayColors:
+            r, g, b = self.getColorFromIndex(colorindex)
+            self._overlayColors[colorindex] = (b << 16) | (g << 8) | r
+        return self._overlayColors[colorindex]
+
+    def _raster_points(self, xs, ys, color):
+        """ Set the camera image pixels at (xs, ys), clipped to the image"""
+
+        h, w = self._imagebuffer.shape
+        xs = numpy.rint(xs).astype(int)
+        ys = numpy.rint(ys).astype(int)
+        keep = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+        self._imagebuffer[ys[keep], xs[keep]] = color
+
+    def _raster_line(self, x1, y1, x2, y2, color):
+        """ Rasterise a 1-pixel line into the camera image"""
+
+        n = int(max(abs(x2 - x1), abs(y2 - y1))) + 1
+        self._raster_points(numpy.linspace(x1, x2, n),
+                            numpy.linspace(y1, y2, n), color)
+
+    def _raster_arc(self, box, start, end, color):
+        """ Rasterise an elliptical arc into the camera image, with the same
+        conventions as PIL's ImageDraw.arc (degrees, clockwise from 3 o'clock)
+        """
+
+        x0, y0, x1, y1 = box
+        if end < start:
+            end += 360
+        rx, ry = (x1 - x0)/2.0, (y1 - y0)/2.0
+        n = int(numpy.radians(end - start) * max(rx, ry)) + 2
+        t = numpy.radians(numpy.linspace(start, end, n))
+        self._raster_points(x0 + rx + rx*numpy.cos(t),
+                            y0 + ry + ry*numpy.sin(t), color)
+
     def draw_line(self, x1, y1, x2, y2, colorindex):
         """ Draw a line. This is used for drawing crosshairs/squares""" 
         
-        color = self.getColorFromIndex(colorindex)
+        color = self._overlay_color(colorindex)
 
-        if self._size[0] > 192:
-            w, h = self._img.im.size
-            x1 = int((float(x1) / 192) * w)
-            x2 = int((float(x2) / 192) * w)
-            y1 = int((float(y1) / 160) * h)
-            y2 = int((float(y2) / 160) * h)
+        sx, sy = self._overlayScale
+        x1, x2 = int(x1 * sx), int(x2 * sx)
+        y1, y2 = int(y1 * sy), int(y2 * sy)
 
         # draw the line
         if not any([x < 0 for x in [x1, x2, y1, y2]]):
-            self._img.line([(x1, y1), (x2, y2)], color)
+            self._raster_line(x1, y1, x2, y2, color)
 
 
     def draw_lozenge(self, x, y, width, height, colorindex):
@@ -503,37 +655,34 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
         (x,y) is top-left corner of the bounding box
         """ 
 
-        color = self.getColorFromIndex(colorindex)
+        color = self._overlay_color(colorindex)
 
-        if self._size[0] > 192:
-            w, h = self._img.im.size
-            x = int((float(x) / 192) * w)
-            y = int((float(y) / 160) * h)
-            width = int((float(width) / 192) * w)
-            height = int((float(height) / 160) * h)
+        sx, sy = self._overlayScale
+        x, width = int(x * sx), int(width * sx)
+        y, height = int(y * sy), int(height * sy)
 
         if width > height:
             rad = int(height / 2.)
             if rad == 0:
                 return
             else:
-                self._img.line([(x + rad, y), (x + width - rad, y)], color, 1)
-                self._img.line([(x + rad, y + height),
-                                (x + width - rad, y + height)], color, 1)
-                self._img.arc([x, y, x + rad*2, y + rad*2], 90, 270, color, 1)
-                self._img.arc([x + width - rad*2, y, x + width, y + height],
-                              270, 90, color, 1)
+                self._raster_line(x + rad, y, x + width - rad, y, color)
+                self._raster_line(x + rad, y + height,
+                                  x + width - rad, y + height, color)
+                self._raster_arc([x, y, x + rad*2, y + rad*2], 90, 270, color)
+                self._raster_arc([x + width - rad*2, y, x + width, y + height],
+                                 270, 90, color)
         else:
             rad = int(width / 2.)
             if rad == 0:
                 return
             else:
-                self._img.line([(x, y + rad), (x, y + height - rad)], color, 1)
-                self._img.line([(x + width, y + rad),
-                                (x + width, y + height - rad)], color, 1)
-                self._img.arc([x, y, x + rad*2, y + rad*2], 180, 360, color, 1)
-                self._img.arc([x, y + height-rad*2, x + rad*2, y + height],
-                              0, 180, color, 1)
+                self._raster_line(x, y + rad, x, y + height - rad, color)
+                self._raster_line(x + width, y + rad,
+                                  x + width, y + height - rad, color)
+                self._raster_arc([x, y, x + rad*2, y + rad*2], 180, 360, color)
+                self._raster_arc([x, y + height-rad*2, x + rad*2, y + height],
+                                 0, 180, color)
 
     def get_mouse_state(self):
         """ Get the current mouse position and status""" 
@@ -558,109 +707,75 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
                 self._calibTar.phases -= 0.02
             self._calibTar.draw()
             self._display.flip()
-        
+
+        self._poll_mouse_simulation()
+
         ky = []
-        #check for key presses 
-        keyPressList = self._kb.getKeys(keyList = None, waitRelease = False, clear = False)
-        #this will store any new key press names
-        newKeyPressList = list()
-        for keyPress in keyPressList:
-            keyPressName = keyPress.name
-            if keyPressName not in self._keyPressNameList:
-                self._keyPressNameList.append(keyPressName)
-                newKeyPressList.append(keyPressName)
-                if keyPressName in ['lctrl','rctrl','lalt','ralt','lshift','rshift']:
-                    self._modifiers[keyPressName] = True
-
-        #go through all new key presses
-        for keycode in newKeyPressList:
-            k = pylink.JUNK_KEY
-            if keycode == 'f1':
-                k = pylink.F1_KEY
-            elif keycode == 'f2':
-                k = pylink.F2_KEY
-            elif keycode == 'f3':
-                k = pylink.F3_KEY
-            elif keycode == 'f4':
-                k = pylink.F4_KEY
-            elif keycode == 'f5':
-                k = pylink.F5_KEY
-            elif keycode == 'f6':
-                k = pylink.F6_KEY
-            elif keycode == 'f7':
-                k = pylink.F7_KEY
-            elif keycode == 'f8':
-                k = pylink.F8_KEY
-            elif keycode == 'f9':
-                k = pylink.F9_KEY
-            elif keycode == 'f10':
-                k = pylink.F10_KEY
-            elif keycode == 'pageup':
-                k = pylink.PAGE_UP
-            elif keycode == 'pagedown':
-                k = pylink.PAGE_DOWN
-            elif keycode == 'up':
-                k = pylink.CURS_UP
-            elif keycode == 'down':
-                k = pylink.CURS_DOWN
-            elif keycode == 'left':
-                k = pylink.CURS_LEFT
-            elif keycode == 'right':
-                k = pylink.CURS_RIGHT
-            elif keycode == 'backspace':
-                k = ord('\b')
-            elif keycode == 'return':
-                k = pylink.ENTER_KEY
-                # Probe the tracker to see if it's "simulating gaze with mouse"
-                # If so, show a warning to experimenter
-                if self._tracker.getCurrentMode() == pylink.IN_SETUP_MODE:
-                    self._tracker.readRequest('aux_mouse_simulation')
-                    pylink.pumpDelay(50)
-                    if self._tracker.readReply() == '1':
-                        self._msgMouseSim.autoDraw = True
-                        self._camImgRect.autoDraw = True
-                        self._calibInst.autoDraw = True
-                        self._display.flip()
-            elif keycode == 'space':
-                k = ord(' ')
-            elif keycode == 'escape':
-                k = 27
-            elif keycode == 'tab':
-                k = ord('\t')
-            elif keycode in string.ascii_letters:
-                k = ord(keycode)
-            elif k == pylink.JUNK_KEY:
-                k = 0
-
-            # Plus/equal & minux signs for CR adjustment
-            if keycode in ['num_add', 'equal']:
-                k = ord('+')
-            if keycode in ['num_subtract', 'minus']:
-                k = ord('-')
-
-            # Handles key modifier, we can send Ctrl-C, Alt-F4
-            # to break out trials, or terminate tasks
-            if self._modifiers['lalt'] is True or self._modifiers['ralt'] is True:
-                mod = 256
-            elif self._modifiers['lctrl'] is True or self._modifiers['rctrl'] is True:
-                mod = 64
-            elif self._modifiers['lshift'] is True or self._modifiers['rshift'] is True:
-                mod = 1
-            else:
+        released = self._drainReleases
+        # one drain per poll: new presses are handed over once, presses
+        # whose duration is set have been released since
+        for keyPress in self._kb.getKeys(keyList=None, waitRelease=False,
+                                         clear=False):
+            keycode = keyPress.name
+            keyId = (keycode, keyPress.tDown)
+            if keyId not in self._keysDown:
+                self._keysDown.add(keyId)
+                if keycode in MODIFIER_KEYS:
+                    self._modifiersHeld.add(keycode)
+
+                k = KEY_MAP.get(keycode, 0)
+                if keycode == 'return':
+                    self._request_mouse_simulation()
+
+                # Handles key modifier, we can send Ctrl-C, Alt-F4
+                # to break out trials, or terminate tasks
                 mod = 0
-
-            ky.append(pylink.KeyInput(k,mod))
-            
-        #check for key releases
-        keyReleaseList = self._kb.getKeys(keyList = None, waitRelease = True, clear = True)
-        for keyRelease in keyReleaseList:
-            keyReleaseName = keyRelease.name
-            if keyReleaseName in self._keyPressNameList:
-                self._keyPressNameList.remove(keyReleaseName)
-                if keyReleaseName in ['lctrl','rctrl','lalt','ralt','lshift','rshift']:
-                    self._modifiers[keyReleaseName] = False
+                for names, code in MODIFIER_CODES:
+                    if not self._modifiersHeld.isdisjoint(names):
+                        mod = code
+                        break
+
+                ky.append(pylink.KeyInput(k, mod))
+            if keyPress.duration is not None:
+                released = True
+
+        # drop released keys from the buffer, only needed after a release
+        if released:
+            for keyRelease in self._kb.getKeys(keyList=None, waitRelease=True,
+                                               clear=True):
+                self._keysDown.discard((keyRelease.name, keyRelease.tDown))
+                self._modifiersHeld.discard(keyRelease.name)
         return ky
 
+    def _request_mouse_simulation(self):
+        """ Ask the Host whether it is "simulating gaze with mouse"; the
+        reply is picked up by _poll_mouse_simulation on later polls"""
+
+        if self._mouseSimRequestTime is None and \
+                self._tracker.getCurrentMode() == pylink.IN_SETUP_MODE:
+            self._tracker.readRequest('aux_mouse_simulation')
+            self._mouseSimRequestTime = core.getTime()
+
+    def _poll_mouse_simulation(self):
+        """ Check for the reply to a mouse simulation request, without
+        waiting; if simulating, show a warning to experimenter"""
+
+        if self._mouseSimRequestTime is None:
+            return
+        reply = self._tracker.readReply()
+        if not reply:
+            # give up on requests the Host never answered
+            if core.getTime() - self._mouseSimRequestTime > 1.0:
+                self._mouseSimRequestTime = None
+            return
+        self._mouseSimRequestTime = None
+        self._mouse_simulation = (reply == '1')
+        if self._mouse_simulation:
+            self._msgMouseSim.autoDraw = True
+            self._camImgRect.autoDraw = True
+            self._calibInst.autoDraw = True
+            self._display.flip()
+
     def exit_image_display(self):
         """ Clear the camera image""" 
 
@@ -689,61 +804,85 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
 
 
         self._size = (width, height)
+        # crosshair/lozenge coordinates refer to a 192 x 160 image for the
+        # larger camera images, compute the scale once per setup
+        if width > 192:
+            self._overlayScale = (width / 192.0, height / 160.0)
+        else:
+            self._overlayScale = (1.0, 1.0)
 
         return 1
 
     def image_title(self, text):
         """ Draw title text below the camera image""" 
 
-        if self.imgResize is not None:
-            im_w, im_h = self.imgResize.size
+        if self._camImage is not None:
+            im_w, im_h = self._camImage.size
             self._title.pos = (0, - im_h/2.0 - self._msgHeight)
         else:
             self._title.pos = (0, -self._size[1]/2 - self._msgHeight)
         self._title.text = text
 
     def draw_image_line(self, width, line, totlines, buff):
-        """ Display image pixel by pixel, line by line""" 
-        i = 0
-        for i in range(width):
-            try:
-                self._imagebuffer.append(self._pal[buff[i]])
-            except:
-                pass
+        """ Display image line by line, mapping the palette indices of each
+        line through the color LUT""" 
+
+        if self._imagebuffer is None or \
+                self._imagebuffer.shape != (totlines, width):
+            self._imagebuffer = numpy.zeros((totlines, width),
+                                            dtype=numpy.uint32)
+
+        try:
+            indices = numpy.frombuffer(buff, dtype=numpy.uint8)
+        except TypeError:
+            indices = numpy.asarray(buff, dtype=numpy.intp)
+        indices = indices[:width]
+
+        row = self._imagebuffer[line - 1]
+        if self._pal is None:
+            row[:] = 0
+        else:
+            # out-of-range indices are masked to black instead of raising
+            colors = numpy.take(self._pal, indices, mode='clip')
+            colors[indices >= len(self._pal)] = 0
+            row[:len(colors)] = colors
+            row[len(colors):] = 0
 
         if line == totlines:
+            # overlays are rasterised straight into the image buffer
+            self.draw_cross_hair()
             bufferv = self._imagebuffer.tobytes()
             img = Image.frombytes("RGBX", (width, totlines), bufferv)
-            self._img = ImageDraw.Draw(img)
-            self.draw_cross_hair()
-            self.imgResize = img.resize((width*2, totlines*2))
-            imgResizeVisual = visual.ImageStim(self._display,
-                                               image=self.imgResize,
-                                               units='pix')
-            imgResizeVisual.draw()
+            if self._camImage is None or \
+                    tuple(self._camImage.size) != (width*2, totlines*2):
+                self._camImage = visual.ImageStim(self._display,
+                                                  image=img,
+                                                  size=(width*2, totlines*2),
+                                                  units='pix',
+                                                  interpolate=False,
+                                                  autoLog=False)
+            else:
+                # reuses the stim's GL texture
+                self._camImage.image = img
+            self._camImage.draw()
             # Change the position of the camera title
             self._title.pos = (0, - totlines*2/2.0 - self._msgHeight)
             self._display.flip()
-            self._imagebuffer = array.array('I')
 
     def set_image_palette(self, r, g, b):
-        """ Given a set of RGB colors, create a list of 24bit numbers
+        """ Given a set of RGB colors, create a LUT of 24bit numbers
         representing the pallet.
 
         i.e., RGB of (1,64,127) would be saved as 82047,
         or the number 00000001 01000000 011111111""" 
 
-        self._imagebuffer = array.array('I')
+        self._imagebuffer = None
 
         sz = len(r)
-        i = 0
-        self._pal = []
-        while i < sz:
-            rf = int(b[i])
-            gf = int(g[i])
-            bf = int(r[i])
-            self._pal.append((rf << 16) | (gf << 8) | (bf))
-            i = i+1
+        rf = numpy.fromiter(b, dtype=numpy.uint32, count=sz)
+        gf = numpy.fromiter(g, dtype=numpy.uint32, count=sz)
+        bf = numpy.fromiter(r, dtype=numpy.uint32, count=sz)
+        self._pal = (rf << 16) | (gf << 8) | bf
 
 
 # A short testing script showing the basic usage of this library
@@ -10,20 +10,36 @@ from psychopy import visual, event, core, monitors, logging, gui, data, misc
 import numpy as np
 import os
 import sys
+import json
 import random
-import pandas as pd
 from PIL import Image
 import pylink
 from EyeLinkCoreGraphicsPsychoPy import EyeLinkCoreGraphicsPsychoPy
+from stim_schedule import build_stim_schedule, save_stim_schedule
+from trigger_listener import TriggerListener
+from frame_writer import AsyncFrameWriter
+from roi_capture import RoiFrameGrabber
+from frame_stack import FrameStackWriter, rgb_to_mask
+from frame_timing import FrameTimingRecorder, STATIC
+from latency_trace import LatencyTracer
+from event_journal import EventJournal
+from display_profiles import (load_profiles, cached_refresh_rate,
+                              store_refresh_rate)
+from edf_transfer import EdfTransfer
+from link_samples import SampleRing, LinkSampleReader
 
 # %% SAVING and LOGGING
+# Display geometry and cached refresh rates, one entry per display
+display_profiles = load_profiles()
+
 # Store info about experiment and experimental run
 expName = 'pRF'  # set experiment name here
 expInfo = {
     'run': '01',
+    'n_runs': '1',  # runs back to back in one session, from 'run' on
     'participant': 'test',
-    'display': ['DBIC', 'TaylorMacbookPro'],
-    'mode': ['experiment','outputMovie'],
+    'display': list(display_profiles),
+    'mode': ['experiment','outputMovie','outputStack'],
     'eyelink':['True', 'False']
     }
 
@@ -33,6 +49,13 @@ if dlg.OK == False: core.quit()  # user pressed cancel
 expInfo['date'] = data.getDateStr()  # add a simple timestamp
 expInfo['expName'] = expName
 
+# The window, stimuli, tracker link and calibration are kept for all runs of
+# the session; expInfo['run'] and expInfo['date'] follow the current run
+first_run = int(expInfo['run'])
+session_runs = ['%0*d' % (len(expInfo['run']), run)
+                for run in range(first_run,
+                                 first_run + max(1, int(expInfo['n_runs'])))]
+
 # get the path that this script is in and change dir to it
 _thisDir = os.path.dirname(os.path.abspath(__file__))  # get current path
 parentDir = os.path.dirname(_thisDir)
@@ -70,32 +93,62 @@ PNGFolderName = dataFolderName + os.path.sep + 'PNG'
 if not os.path.isdir(PNGFolderName):
     os.makedirs(PNGFolderName)
 
+# Name and create folder for the per-run design-matrix stacks
+StackFolderName = dataFolderName + os.path.sep + 'Stack'
+if not os.path.isdir(StackFolderName):
+    os.makedirs(StackFolderName)
+
+# outputMovie saves one PNG per TR, outputStack one binary mask stack per run
+save_frames = expInfo['mode'] in ['outputMovie', 'outputStack']
+# read back only the aperture bounding box instead of the whole screen
+# (always on in outputStack mode), optionally downsampled to
+# capture_grid x capture_grid pixels
+capture_roi = False
+capture_grid = None  # e.g. 101
+# time every pylink calibration callback and log a summary table each time
+# the calibration display is exited
+profile_calibration = False
+# reuse the refresh rate cached in display_profiles.local.json unless it is
+# older than refresh_max_age_days, or measure it again anyway
+refresh_max_age_days = 30
+force_refresh_measurement = False
+# give up the drift check between runs after this many failed attempts
+max_drift_check_failures = 3
+# read gaze samples over the link during each run into a ring buffer
+# (sample_ring, for gaze-contingent code) and Output/link_samples_Run*.npy;
+# when on, the tracker is set to link_sample_rate (250, 500, 1000 or 2000,
+# check your tracker specification), which the reader's gap count assumes
+read_link_samples = False
+link_sample_rate = 1000
+link_spill_seconds = 1200  # longest run, including the instruction screens
+
 # save a log file and set level for msg to be received
 logFile = logging.LogFile(logFileName+'.log', level=logging.INFO)
 logging.console.setLevel(logging.WARNING)  # set console to receive warningVEs
 
+
+def start_run_log():
+    """ Log to a new file for the run in expInfo['run'] """
+
+    global logFile, logFileName
+    logging.flush()
+    logging.root.removeTarget(logFile)
+    logFileName = logFolderName + os.path.sep + '%s_%s_Run%s_%s' % (
+        expInfo['participant'], expInfo['expName'], expInfo['run'],
+        expInfo['date'])
+    logFile = logging.LogFile(logFileName+'.log', level=logging.INFO)
+
 # %% MONITOR AND WINDOW
-# set monitor information:
-if expInfo['display'] == 'DBIC':
-    distanceMon = 128.7  
-    widthMon = 42.8 
-    PixW = 1920.0 
-    PixH = 1080.0  
-elif expInfo['display'] == 'TaylorMacbookPro':
-    distanceMon = 50 
-    widthMon = 30.41 
-    PixW = 3024.0 
-    PixH = 1964.0  
+# set monitor information from the display profile:
+display_profile = display_profiles[expInfo['display']]
+distanceMon = display_profile['distance_cm']
+widthMon = display_profile['width_cm']
+PixW = float(display_profile['pix_w'])
+PixH = float(display_profile['pix_h'])
 
 moni = monitors.Monitor('testMonitor', width=widthMon, distance=distanceMon)
 moni.setSizePix([PixW, PixH]) 
 
-# log monitor info
-logFile.write('MonitorDistance=' + str(distanceMon) + 'cm' + '\n')
-logFile.write('MonitorWidth=' + str(widthMon) + 'cm' + '\n')
-logFile.write('PixelWidth=' + str(PixW) + '\n')
-logFile.write('PixelHeight=' + str(PixH) + '\n')
-
 # specificy background color
 backColor = [-0.5, -0.5, -0.5]  # from -1 (black) to 1 (white)
 # set screen:
@@ -110,52 +163,16 @@ myWin = visual.Window(size=(PixW, PixH),
                       colorSpace='rgb',
                       units='deg',
                       blendMode='avg',
-                      waitBlanking=True
+                      waitBlanking=True,
+                      autoLog=False  # no repr dump and per-attribute lines
                       )
 
 # %% STIMULI SCHEDULE SETUP
-np.random.seed(42)  # Global seed for reproducibility
-
-stim_schedule = []
-
 orientations = [0, 45, 90, 135]
 n_steps = 12
 n_reps = 12
 aperture_radius = 5  # dva
 
-# Sweep offsets from -5° to 5°
-base_offsets = np.linspace(-aperture_radius, aperture_radius, n_steps)
-
-for rep in range(n_reps):
-    for ori in orientations:
-        # Generate new shuffled offset list for each ori × rep
-        sweep_offsets = np.copy(base_offsets)
-        np.random.shuffle(sweep_offsets)
-
-        angle_deg = ori - 90
-        angle_rad = np.deg2rad(angle_deg)
-        dx = np.cos(angle_rad)
-        dy = np.sin(angle_rad)
-
-        if ori in [45, 135]:
-            dx *= -1
-
-        norm = np.sqrt(dx**2 + dy**2)
-        dx /= norm
-        dy /= norm
-
-        for step_num, offset in enumerate(sweep_offsets):
-            pos_x = offset * dx
-            pos_y = offset * dy
-
-            stim_schedule.append({
-                'rep': rep + 1,
-                'orientation': ori,
-                'position': (pos_x, pos_y),
-                'step': step_num + 1,
-                'fix_change': 0
-            })
-
 # in case we need fixation task 
 '''
 # === Pick 30 non-adjacent fixation change indices ===
@@ -176,31 +193,29 @@ for idx in selected_indices:
     stim_schedule[idx]['fix_change'] = 1
 '''
 
-# Convert stim_schedule to DataFrame
-df = pd.DataFrame(stim_schedule)
-df.to_csv(os.path.join(outFolderName, 'stim_schedule.csv'), index=False)
-
 # %% TIME AND TIMING PARAMeTERS
 # parameters
 '''
 totalTrigger = np.sum(Durations)
 '''
-# get screen refresh rate
-for _ in range(10):
-    myWin.flip()  # Flip the window a few times
-refr_rate = myWin.getActualFrameRate()  # get screen refresh rate
+# get screen refresh rate, measured only if the cached one is stale
+refr_rate = cached_refresh_rate(display_profile,
+                                max_age_days=refresh_max_age_days)
+if refr_rate is None or force_refresh_measurement:
+    for _ in range(10):
+        myWin.flip()  # Flip the window a few times
+    refr_rate = myWin.getActualFrameRate()  # get screen refresh rate
+    if refr_rate is not None:
+        display_profile = store_refresh_rate(expInfo['display'], refr_rate)
 
 print(f"refr_rate{refr_rate}")
 
-refr_rate = 60.0 # if could not get reliable refresh rate
-
-if refr_rate is not None:
-    frameDur = 1.0/round(refr_rate)
-else:
-    frameDur = 1.0/round(refr_rate)  # couldn't get a reliable measure so guess
-
-logFile.write('RefreshRate=' + str(refr_rate) + '\n')
-logFile.write('FrameDuration=' + str(frameDur) + '\n')
+if refr_rate is None:
+    refr_rate = 60.0  # couldn't get a reliable measure so guess
+# frame counts are derived from the nominal rate, so that a measurement of
+# 59.99 or 60.02 Hz gives the same flicker and frame timing
+nominal_refr_rate = int(round(refr_rate))
+frameDur = 1.0/nominal_refr_rate
 
 # define clock
 clock = core.Clock()
@@ -214,7 +229,43 @@ bar_width = 0.9     # degrees
 n_checks_x = 32     # horizontal grids
 n_checks_y = 3      # vertical grids
 flicker_rate = 8    # Hz
-flicker_interval = 1.0 / flicker_rate
+
+# === Frame-locked flicker: A/B phase of every refresh in one flicker cycle
+# Frames per phase come from the nominal refresh rate, so every session on
+# a display flickers at the same rate. Ties are rounded up (60 Hz / 8 Hz =
+# 7.5 gives 8 frames, 7.5 Hz): the slower of the two nearest rates.
+frames_per_phase = max(1, int(nominal_refr_rate / float(flicker_rate) + 0.5))
+flicker_phases = np.repeat([0, 1], frames_per_phase)
+achieved_flicker_rate = nominal_refr_rate / float(frames_per_phase)
+print(f"flicker {achieved_flicker_rate:.3f} Hz, "
+      f"{frames_per_phase} frames per phase")
+if abs(achieved_flicker_rate - flicker_rate) > 1e-6:
+    logging.warning('Refresh rate %.2f Hz is not a multiple of %d Hz, '
+                    'flickering at %.3f Hz (%d frames per phase)' % (
+                        refr_rate, flicker_rate, achieved_flicker_rate,
+                        frames_per_phase))
+
+
+def write_log_header():
+    """ Display, timing and flicker parameters at the top of a run log """
+
+    # log monitor info
+    logFile.write('Display=' + expInfo['display'] + '\n')
+    logFile.write('Mode=' + expInfo['mode'] + '\n')
+    logFile.write('MonitorDistance=' + str(distanceMon) + 'cm' + '\n')
+    logFile.write('MonitorWidth=' + str(widthMon) + 'cm' + '\n')
+    logFile.write('PixelWidth=' + str(PixW) + '\n')
+    logFile.write('PixelHeight=' + str(PixH) + '\n')
+    logFile.write('RefreshRate=' + str(refr_rate) + '\n')
+    logFile.write('NominalRefreshRate=' + str(nominal_refr_rate) + '\n')
+    logFile.write('RefreshRateMeasured=' +
+                  str(display_profile['refresh_measured']) + '\n')
+    logFile.write('FrameDuration=' + str(frameDur) + '\n')
+    logFile.write('FlickerRate=' + str(achieved_flicker_rate) + '\n')
+    logFile.write('FramesPerFlickerPhase=' + str(frames_per_phase) + '\n')
+
+
+write_log_header()
 
 
 # === Create bar-shaped checkerboard with 3 rows and 32 columns ===
@@ -241,7 +292,8 @@ checker_A = visual.ImageStim(
     image=checker_img,
     size=(bar_length, bar_width),
     units='deg',
-    interpolate=False
+    interpolate=False,
+    autoLog=False  # ori/pos change every TR, events go to event_journal
 )
 
 checker_B = visual.ImageStim(
@@ -249,11 +301,12 @@ checker_B = visual.ImageStim(
     image=checker_img_inv,
     size=(bar_length, bar_width),
     units='deg',
-    interpolate=False
+    interpolate=False,
+    autoLog=False  # ori/pos change every TR, events go to event_journal
 )
 
 # If we want to output movie, we want the white instead of checker board. 
-if expInfo['mode'] == 'outputMovie':
+if save_frames:
     checker_A.image = white_bar_img
     checker_B.image = white_bar_img
 
@@ -261,15 +314,134 @@ if expInfo['mode'] == 'outputMovie':
 aperture = visual.Aperture(
     win=myWin,
     size=10.0,  # diameter in degrees
-    shape='circle'
+    shape='circle',
+    autoLog=False
 )
 
+# === Frame capture: the aperture readback is set up once per session
+roi_grabber = None
+if save_frames and (capture_roi or expInfo['mode'] == 'outputStack'):
+    roi_grabber = RoiFrameGrabber(myWin, radius_deg=aperture_radius,
+                                  target_size=capture_grid)
+frame_writer = None
+frame_stack = None
+
+
+def prepare_run():
+    """ Schedule, recorders and frame writers of the run in expInfo['run']"""
+
+    global stim_schedule, frame_timing, latency_tracer, event_journal
+    global frame_writer, frame_stack
+
+    # Compiled (and cached) by stim_schedule.py; each run has its own shuffle
+    stim_schedule = build_stim_schedule(runs=int(expInfo['run']),
+                                        orientations=orientations,
+                                        n_steps=n_steps,
+                                        n_reps=n_reps,
+                                        aperture_radius=aperture_radius,
+                                        seed=42)
+
+    # Save stim_schedule as typed .npy (+ CSV with the same numeric columns)
+    save_stim_schedule(os.path.join(outFolderName,
+                                    'stim_schedule_Run%s' % expInfo['run']),
+                       stim_schedule)
+
+    # === Frame timing: every flip of the run, tagged with TR and flicker
+    # phase (STATIC for held fixation screens)
+    frame_timing = FrameTimingRecorder(
+        nominal_refr_rate,
+        capacity=int((10 + len(stim_schedule) + 16) * refr_rate * 1.1))
+
+    # === Trigger-to-photon latency of every trigger that changes the stimulus
+    latency_tracer = LatencyTracer(frameDur, capacity=len(stim_schedule) + 2)
+
+    # === Triggers, responses and onsets of the run, written in bulk to
+    # Output while the screen is static (stimuli do not autoLog)
+    event_journal = EventJournal(os.path.join(
+        outFolderName, 'events_Run%s.bin' % expInfo['run']))
+
+    # === Frame capture: frames are encoded and written off the trigger
+    # path, flushed in finish_frame_capture
+    if expInfo['mode'] == 'outputMovie':
+        run_png_folder = os.path.join(PNGFolderName, 'Run%s' % expInfo['run'])
+        if not os.path.isdir(run_png_folder):
+            os.makedirs(run_png_folder)
+        frame_writer = AsyncFrameWriter(max_pending=64, policy='block')
+    elif expInfo['mode'] == 'outputStack':
+        frame_stack = FrameStackWriter(
+            os.path.join(StackFolderName, 'Run%s' % expInfo['run']),
+            capacity=10 + len(stim_schedule) + 15)
+        background_level = (backColor[0] + 1) / 2.0 * 255
+        # a single worker keeps the frames in TR order
+        frame_writer = AsyncFrameWriter(
+            save_fn=lambda tr, frame, stack=frame_stack: stack.append(
+                rgb_to_mask(frame, background_level), tr),
+            max_pending=64, policy='block', n_workers=1)
+
+
+def finish_frame_capture():
+    """ Write out the captured frames of the run still queued """
+
+    global frame_writer, frame_stack
+    if roi_grabber is not None:
+        for done_target, frame in roi_grabber.flush():
+            frame_writer.submit(done_target, frame)
+    if frame_writer is not None:
+        frame_writer.close()
+    if frame_stack is not None:
+        frame_stack.close()
+    frame_writer = None
+    frame_stack = None
+
+
+def wait_for_key(listener, keys, pump_interval=0.1):
+    """ Block on the listener queue until one of keys arrives
+
+    A window that is not flipped stops pumping its events, and Windows and
+    macOS mark a fullscreen window as not responding after a few seconds,
+    so the window events are dispatched every pump_interval seconds while
+    the queue does the waiting.
+
+    Returns:
+        the TriggerEvent
+    """
+    while True:
+        evt = listener.wait_for(keys, timeout=pump_interval)
+        if evt is not None:
+            return evt
+        myWin.winHandle.dispatch_events()
+
+
+def abort_run(listener, t_escape):
+    """ Escape during a run: keep what was recorded so far and quit
+
+    Args:
+        listener: running TriggerListener of the run
+        t_escape: time of the escape key press
+    """
+    listener.stop()
+    event_journal.log('escape', t_escape, frame_idx)
+    event_journal.close()
+    # the verdict of the run for session_index.py, AbortTime on the log clock
+    logFile.write('AbortTime=' + str(t_escape - core.getTime()
+                                     + clock.getTime()) + '\n')
+    logFile.write('Triggers=' + str(len(listener.trigger_times)) + '\n')
+    logFile.write('RunCompleted=False\n')
+    # the frames captured so far are still queued or in flight
+    finish_frame_capture()
+    myWin.close()
+    core.quit()
+
+
+prepare_run()
+
 triggerText = visual.TextStim(
     win=myWin,
     color='white',
     height=0.5,
     pos=(0, 1.5),
-    text='Experiment will start soon.\n Waiting for scanner'
+    text='Experiment will start soon.\n Waiting for scanner',
+    autoLog=False
     )
 
 instructText = visual.TextStim(
@@ -277,7 +449,8 @@ instructText = visual.TextStim(
     color='white',
     height=0.5,
     pos=(0, 1.5),
-    text='Please Fixate on the dot at all times.\n Your fixation is monitored by eyetracker. \n Press 1 immediately to continue'
+    text='Please Fixate on the dot at all times.\n Your fixation is monitored by eyetracker. \n Press 1 immediately to continue',
+    autoLog=False
 )
 
 # fixation dot
@@ -296,90 +469,132 @@ endText = visual.TextStim(
     win=myWin,
     color="white",
     height=0.5,
-    text="Please rest until further instructions"
+    text="Please rest until further instructions",
+    autoLog=False
     )
 # %% FUNCTION encapsulating stimuli 
 
-def flicker_until_trigger(win, stim_A, stim_B, flicker_rate, position=(0, 0),
-                          fix_stim=None, first_run=False, 
-                          save_frames=False, outFolder=None):
-    flicker_interval = 1.0 / flicker_rate
-    clock = core.Clock()
-    last_flip_time = clock.getTime()
+def capture_frame(win, outFolder):
+    """ Grab the front buffer and hand it to the background frame writer"""
+
+    if frame_stack is not None:
+        target = frame_idx  # TR index of the frame in the stack
+    else:
+        # one folder per run, runs of a session do not overwrite each other
+        target = os.path.join(outFolder, 'Run%s' % expInfo['run'],
+                              f"frame_{frame_idx:03d}.png")
+    if roi_grabber is not None:
+        # asynchronous: returns the frame(s) whose readback has completed
+        for done_target, frame in roi_grabber.grab(target):
+            frame_writer.submit(done_target, frame)
+    else:
+        image = win.getMovieFrame(buffer='front')
+        win.movieFrames.pop()  # the writer owns the frame from here on
+        frame_writer.submit(target, image)
+
+
+def flicker_until_trigger(win, listener, stim_A, stim_B, phases,
+                          position=(0, 0), fix_stim=None, save_frames=False,
+                          outFolder=None):
+    """
+    Counterphase-flicker a bar until the next '5' trigger, locked to frames.
+
+    Every loop iteration draws one refresh and flips on the vsync
+    (waitBlanking), so each phase lasts exactly its number of frames. The
+    first flip answers the previous trigger and is traced by latency_tracer.
+
+    Args:
+        win: PsychoPy window
+        listener: running TriggerListener, drained once per flip
+        stim_A, stim_B: the two counterphase stimuli
+        phases: 0/1 (A/B) per refresh for one flicker cycle
+        position: bar centre
+        fix_stim: fixation stimulus drawn on top, unless saving frames
+    """
     global frame_idx
-    flicker_index = 0  # ✅ independent counter for flickering
+    stims = (stim_A, stim_B)
+    stim_A.pos = position
+    stim_B.pos = position
+    n_phases = len(phases)
+    frame_n = 0
 
-    # === Immediate display if first run
-    if first_run:
-        stim_A.pos = position
-        stim_A.draw()
+    while True:
+        phase = phases[frame_n % n_phases]
+        stims[phase].draw()
         if fix_stim and not save_frames:
             fix_stim.draw()
-        win.flip()
-
-    while True:
-        keys = event.getKeys()
+        if frame_n == 0:
+            latency_tracer.stimulus_drawn(win)
+        t_flip = win.flip()
+        frame_timing.record(t_flip, frame_idx, phase)
+        if frame_n == 0:
+            event_journal.log('bar_onset', t_flip, frame_idx, stim_A.ori)
+        frame_n += 1
+
+        events = listener.drain()
+        for evt in events:
+            if evt.key == '5':
+                event_journal.log('trigger', evt.t_down, frame_idx + 1)
+            elif evt.key == '1':
+                event_journal.log('response', evt.t_down, frame_idx)
+        keys = [evt.key for evt in events]
         if 'escape' in keys:
-            win.close()
-            core.quit()
+            abort_run(listener, next(
+                evt.t_down for evt in events if evt.key == 'escape'))
         if '5' in keys:
-            # Redraw final frame for saving
-            stim = stim_A if flicker_index % 2 == 0 else stim_B
-            stim.pos = position
-            stim.draw()
-            if fix_stim and not save_frames:
-                fix_stim.draw()
-            win.flip()
-
+            # the frame on screen at the trigger is the one we save
             if save_frames and outFolder is not None:
-                win.getMovieFrame(buffer='front')
-                win.saveMovieFrames(os.path.join(outFolder, f"frame_{frame_idx:03d}.png"))
+                capture_frame(win, outFolder)
             frame_idx += 1  # ✅ increment only ONCE per TR
+            latency_tracer.trigger(frame_idx, next(
+                evt.t_down for evt in events if evt.key == '5'))
             break
-
-        now = clock.getTime()
-        if now - last_flip_time >= flicker_interval:
-            stim = stim_A if flicker_index % 2 == 0 else stim_B
-            stim.pos = position
-            stim.draw()
-            if fix_stim and not save_frames:
-                fix_stim.draw()
-            win.flip()
-            last_flip_time = now
-            flicker_index += 1  # ✅ flicker toggling only
             
 
-def show_fixation_until_triggers(win, fix_stim, num_triggers=10, save_frames=False, 
-                                 outFolder=None):
+def show_fixation_until_triggers(win, listener, fix_stim, num_triggers=10,
+                                 save_frames=False, outFolder=None,
+                                 trace_last=True):
     """
     Show fixation stimulus and wait for a specified number of '5' triggers.
 
+    The fixation screen is static, so it is flipped once and the wait blocks
+    on the trigger queue (pumping the window events, see wait_for_key).
+
     Args:
         win: PsychoPy window
+        listener: running TriggerListener
         fix_stim: A visual stimulus (e.g., dotFix) to be drawn
         num_triggers: Number of '5' triggers to wait for
+        trace_last: a new stimulus follows the last trigger, trace its
+            latency
     """
     n_triggers = 0
+    evt = None
     global frame_idx
-    
+
+    if not save_frames:
+        fix_stim.draw()
+    latency_tracer.stimulus_drawn(win)
+    t_flip = win.flip()
+    frame_timing.record(t_flip, frame_idx, STATIC)
+    event_journal.log('fixation_onset', t_flip, frame_idx)
+    # the screen is held until the next trigger, write the journal now
+    event_journal.flush()
+
     while n_triggers < num_triggers:
-        keys = event.getKeys()
-        if 'escape' in keys:
-            win.close()
-            core.quit()
-        
-        if '5' in keys:
-            n_triggers += 1
-    
-            # Save frame ONLY at trigger
-            if save_frames and frame_idx is not None and outFolder is not None:
-                win.getMovieFrame(buffer='front')
-                win.saveMovieFrames(os.path.join(outFolder, f"frame_{frame_idx:03d}.png"))
-                frame_idx += 1
-        elif save_frames==False:
-            # Just show fixation without saving
-            fix_stim.draw()
-        win.flip()
+        evt = wait_for_key(listener, ['5', 'escape'])
+        if evt.key == 'escape':
+            abort_run(listener, evt.t_down)
+        n_triggers += 1
+        event_journal.log('trigger', evt.t_down, frame_idx + 1)
+
+        # Save frame ONLY at trigger
+        if save_frames and frame_idx is not None and outFolder is not None:
+            capture_frame(win, outFolder)
+        # frame_idx counts TRs in every mode, it tags the timing records
+        frame_idx += 1
+    if trace_last and evt is not None:
+        latency_tracer.trigger(frame_idx, evt.t_down)
 
 # %% EYELINK SETUP
 # Set this variable to True if you use the built-in retina screen as your
@@ -429,24 +644,35 @@ else:
         core.quit()
         sys.exit()
 
-# Step 2: Open an EDF data file on the Host PC
-edf_file =  f"RF_run{expInfo['run']}.EDF"
-try:
-    el_tracker.openDataFile(edf_file)
-except RuntimeError as err:
-    print('ERROR:', err)
-    # close the link if we have one open
-    if el_tracker.isConnected():
-        el_tracker.close()
-    core.quit()
-    sys.exit()
-# Add a header text to the EDF file to identify the current experiment name
-# This is OPTIONAL. If your text starts with "RECORDED BY " it will be
-# available in DataViewer's Inspector window by clicking
-# the EDF session node in the top panel and looking for the "Recorded By:"
-# field in the bottom panel of the Inspector.
-preamble_text = 'RECORDED BY %s' % os.path.basename(__file__)
-el_tracker.sendCommand("add_file_preamble_text '%s'" % preamble_text)
+# EDF files are downloaded on a worker thread, size-checked and retried,
+# while the next run is set up; there is nothing to retrieve in dummy mode
+edf_transfer = EdfTransfer(el_tracker, retries=0 if dummy_mode else 3)
+
+# Step 2: Open an EDF data file on the Host PC, one per run
+def open_edf():
+    """ Open the EDF of the run in expInfo['run'] on the Host PC """
+
+    global edf_file
+    edf_file =  f"RF_run{expInfo['run']}.EDF"
+    try:
+        el_tracker.openDataFile(edf_file)
+    except RuntimeError as err:
+        print('ERROR:', err)
+        # close the link if we have one open
+        if el_tracker.isConnected():
+            el_tracker.close()
+        core.quit()
+        sys.exit()
+    # Add a header text to the EDF file to identify the current experiment
+    # name. This is OPTIONAL. If your text starts with "RECORDED BY " it
+    # will be available in DataViewer's Inspector window by clicking
+    # the EDF session node in the top panel and looking for the
+    # "Recorded By:" field in the bottom panel of the Inspector.
+    preamble_text = 'RECORDED BY %s' % os.path.basename(__file__)
+    el_tracker.sendCommand("add_file_preamble_text '%s'" % preamble_text)
+
+
+open_edf()
 
 # Put the tracker in offline mode before we change tracking parameters
 el_tracker.setOfflineMode()
@@ -486,6 +712,10 @@ el_tracker.sendCommand("link_sample_data = %s" % link_sample_flags)
 # Sample rate, 250, 500, 1000, or 2000, check your tracker specification
 # if eyelink_ver > 2:
 #     el_tracker.sendCommand("sample_rate 1000")
+# the link sample reader needs to know the rate, so it is set from the
+# same value
+if read_link_samples and eyelink_ver > 2:
+    el_tracker.sendCommand("sample_rate %d" % link_sample_rate)
 # Choose a calibration type, H3, HV3, HV5, HV13 (HV = horizontal/vertical),
 el_tracker.sendCommand("calibration_type = HV5")
 
@@ -509,6 +739,11 @@ os.chdir(_thisDir) # make sure that EyeLinkCoreGraphicsPsychoPy can be read
 #sound.AudioDeviceInfo(deviceIndex = -1, deviceName =u'Microsoft Sound Mapper - Output', inputChannels = 0, outputLatency = (0.09, 0.18), inputLatency = (0.09, 0.18), defaultSampleRate = 44100)
 genv = EyeLinkCoreGraphicsPsychoPy(el_tracker, myWin)
 print(genv)  # print out the version number of the CoreGraphics library
+if profile_calibration:
+    def report_calibration_profile(summary):
+        print(summary)
+        logFile.write('CalibrationProfile=\n' + summary + '\n')
+    genv.enableProfiling(report=report_calibration_profile)
 
 # Set background and foreground colors for the calibration target
 # in PsychoPy, (-1, -1, -1)=black, (1, 1, 1)=white, (0, 0, 0)=mid-gray
@@ -533,6 +768,10 @@ genv.setTargetType('picture')
 
 genv.setPictureTarget(os.path.join(_thisDir,'images', 'fixTarget.bmp'))
 
+# Build the target once and upload it now, so entering calibration,
+# validation and drift checks reuses it
+genv.prewarmCalTarget()
+
 # Configure the size of the calibration target (in pixels)
 # this option applies only to "circle" and "spiral" targets
 # genv.setTargetSize(24)
@@ -592,6 +831,77 @@ def abort_trial():
     el_tracker.sendMessage('TRIAL_RESULT %d' % pylink.TRIAL_ERROR)
     return pylink.TRIAL_ERROR
 
+def close_edf():
+    """ Close the EDF of the current run and retrieve it from the Host """
+
+    global edf_file
+    el_tracker = pylink.getEYELINK()
+    # Put tracker in Offline mode
+    el_tracker.setOfflineMode()
+    # Clear the Host PC screen and wait for 500 ms
+    el_tracker.sendCommand('clear_screen 0')
+    pylink.msecDelay(500)
+    # Close the edf data file on the Host
+    el_tracker.closeDataFile()
+    # Download the EDF data file from the Host PC to a local data folder
+    # in the background; wait_for_edf_transfer() shows the progress
+    # parameters: source_file_on_the_host, destination_file_on_local_drive
+    local_edf = os.path.join(session_folder, edf_file)
+    print("LOCAL_EDF = " + local_edf)
+    edf_transfer.submit(edf_file, local_edf)
+    edf_file = None
+
+def wait_for_edf_transfer():
+    """ Show a file transfer message until the queued EDFs are retrieved;
+    the link is not used while a file is transferred """
+
+    while not edf_transfer.wait(timeout=0.25):
+        current = edf_transfer.current
+        if current is not None:
+            msg = 'EDF data is transferring from EyeLink Host PC...\n' + \
+                '%.1f MB' % (current[1] / 1e6)
+            show_msg(myWin, msg, wait_for_keypress=False)
+
+def drift_check():
+    """ Drift-check between runs instead of a full calibration; ESC on the
+    drift-check screen brings up the camera setup """
+
+    el_tracker = pylink.getEYELINK()
+    aperture.enabled = False  # no masking on the tracker graphics
+    n_failed = 0
+    while not dummy_mode:
+        # terminate the task if no longer connected to the tracker or
+        # user pressed Ctrl-C to terminate the task
+        if (not el_tracker.isConnected()) or el_tracker.breakPressed():
+            terminate_task()
+        # drift-check and re-do camera setup if ESCAPE is pressed
+        try:
+            error = el_tracker.doDriftCorrect(int(scn_width/2.0),
+                                              int(scn_height/2.0), 1, 1)
+            # break following a success drift-check
+            if error != pylink.ESC_KEY:
+                break
+        except RuntimeError as err:
+            n_failed += 1
+            print('WARNING: drift check failed:', err)
+            if n_failed >= max_drift_check_failures:
+                print('WARNING: no drift check before run ' +
+                      str(expInfo['run']))
+                break
+
+def start_run(run):
+    """ Switch the session over to the next run: log, schedule, EDF """
+
+    expInfo['run'] = run
+    expInfo['date'] = data.getDateStr()
+    start_run_log()
+    write_log_header()
+    clock.reset()
+    prepare_run()
+    # the previous run's EDF downloads while the above is set up
+    wait_for_edf_transfer()
+    open_edf()
+
 def terminate_task():
     """ Terminate the task gracefully and retrieve the EDF data file
 
@@ -599,31 +909,25 @@ def terminate_task():
     win: the current window used by the experimental script
     """
     el_tracker = pylink.getEYELINK()
+    # the link is not used while an earlier run's EDF is transferred
+    wait_for_edf_transfer()
     if el_tracker.isConnected():
         # Terminate the current trial first if the task terminated prematurely
         error = el_tracker.isRecording()
         if error == pylink.TRIAL_OK:
             abort_trial()
-        # Put tracker in Offline mode
-        el_tracker.setOfflineMode()
-        # Clear the Host PC screen and wait for 500 ms
-        el_tracker.sendCommand('clear_screen 0')
-        pylink.msecDelay(500)
-        # Close the edf data file on the Host
-        el_tracker.closeDataFile()
-        # Show a file transfer message on the screen
-        #msg = 'EDF data is transferring from EyeLink Host PC...'
-        #show_msg(myWin, msg, wait_for_keypress=False)
-        # Download the EDF data file from the Host PC to a local data folder
-        # parameters: source_file_on_the_host, destination_file_on_local_drive
-        local_edf = os.path.join(session_folder, edf_file)
-        print("LOCAL_EDF = " + local_edf)
-        try:
-            el_tracker.receiveDataFile(edf_file, local_edf)
-        except RuntimeError as error:
-            print('ERROR:', error)
+        # Close and download the EDF of the run, unless that is done
+        if edf_file is not None:
+            close_edf()
+        wait_for_edf_transfer()
+        for result in edf_transfer.close():
+            if result.ok:
+                print('%s: %d bytes, sha256 %s' % (
+                    result.local_file, result.size, result.sha256))
         # Close the link to the tracker.
         el_tracker.close()
+    # write out any captured frames still queued
+    finish_frame_capture()
     # close the PsychoPy window
     myWin.close()
     # quit PsychoPy
@@ -650,99 +954,174 @@ if not dummy_mode:
         print('ERROR:', err)
         el_tracker.exitCalibration()
 
-# put tracker in idle/offline mode before recording
-el_tracker.setOfflineMode()
-# Start recording
-# arguments: sample_to_file, events_to_file, sample_over_link,
-# event_over_link (1-yes, 0-no)
-try:
-    el_tracker.startRecording(1, 1, 1, 1)
-except RuntimeError as error:
-    print("ERROR:", error)
-    abort_trial()
-
-
-
 # %% SIMPLE FLICKERING CHECKERBOARD BAR — No movement
 # Show flickering bar at fixed center position for 5 seconds
 
-aperture.enabled = True  # globally enable masking
-first_run = True  # control initial display behavior to display flicker without trigger
-
-# Instruction
-instructText.draw()
-dotFix.draw()
-myWin.flip()
-# Wait for keypress
-while True:
-    keys = event.getKeys()
-    if '1' in keys:
-        break
-    elif 'escape' in keys:
-        myWin.close()
-        core.quit()
-
-# Scanner ready
-triggerText.draw()
-dotFix.draw()
-myWin.flip()
-# Wait for scanner trigger ('5')
-while True:
-    keys = event.getKeys()
-    if '5' in keys:
-        break
-    elif 'escape' in keys:
-        myWin.close()
-        core.quit()
-
-# for white bar savinf 
-frame_idx = 0
-
-el_tracker.sendMessage(f"EXPERIMENT_START {expInfo['expName']}")
+def run_scan():
+    """ Present one run: instructions, scanner triggers, bar sweeps """
 
-# Beginning fixation
-show_fixation_until_triggers(myWin, dotFix, num_triggers=10, 
-                             save_frames=(expInfo['mode'] == 'outputMovie'),
-                             outFolder=PNGFolderName)
-
-first_run = True
-for step in stim_schedule:
-    position = step['position']
-    orientation = step['orientation']
-    
-    # Optional: rotate stimuli here if orientation changes
-    checker_A.ori = orientation
-    checker_B.ori = orientation
-    aperture.enabled = True  # enable for current frame
-    
-    flicker_until_trigger(myWin, checker_A, checker_B, flicker_rate=8,
-                      position=position,
-                      fix_stim=dotFix,
-                      first_run=first_run,
-                      save_frames=(expInfo['mode'] == 'outputMovie'),
-                      outFolder=PNGFolderName
-                      )
-    
-    
-    first_run = False
+    global frame_idx
+    frame_idx = -1  # no TR before the scanner-ready trigger
+    aperture.enabled = True  # globally enable masking
+
+    # Triggers and responses are timestamped by a background listener from
+    # here on (the tracker setup or drift check no longer reads the keyboard)
+    trigger_listener = TriggerListener(keys=('5', '1', 'escape'))
+    trigger_listener.start()
+
+    # Instruction
+    instructText.draw()
+    dotFix.draw()
+    myWin.flip()
+    # Wait for keypress
+    evt = wait_for_key(trigger_listener, ['1', 'escape'])
+    if evt.key == 'escape':
+        abort_run(trigger_listener, evt.t_down)
+
+    # Scanner ready
+    triggerText.draw()
+    dotFix.draw()
+    myWin.flip()
+    # Wait for scanner trigger ('5')
+    scanner_ready = wait_for_key(trigger_listener, ['5', 'escape'])
+    if scanner_ready.key == 'escape':
+        abort_run(trigger_listener, scanner_ready.t_down)
+
+    # for white bar savinf 
+    frame_idx = 0
+    latency_tracer.trigger(frame_idx, scanner_ready.t_down)
+    event_journal.log('run_start', scanner_ready.t_down, frame_idx)
+
+    # the link sample reader may be draining the link on its thread
+    with edf_transfer.link_lock:
+        el_tracker.sendMessage(f"EXPERIMENT_START {expInfo['expName']}")
+
+    # Beginning fixation
+    show_fixation_until_triggers(myWin, trigger_listener, dotFix, num_triggers=10,
+                                 save_frames=save_frames,
+                                 outFolder=PNGFolderName)
+
+    for step in stim_schedule:
+        position = (step['pos_x'], step['pos_y'])
+        orientation = step['orientation']
+
+        # Optional: rotate stimuli here if orientation changes
+        checker_A.ori = orientation
+        checker_B.ori = orientation
+        aperture.enabled = True  # enable for current frame
+
+        flicker_until_trigger(myWin, trigger_listener, checker_A, checker_B,
+                          flicker_phases,
+                          position=position,
+                          fix_stim=dotFix,
+                          save_frames=save_frames,
+                          outFolder=PNGFolderName
+                          )
+
+    # End fixation 
+    show_fixation_until_triggers(myWin, trigger_listener, dotFix, num_triggers=16-1, # trigger at the end of each volume should -1 other wise it will be 17
+                                 save_frames=save_frames,
+                                 outFolder=PNGFolderName,
+                                 trace_last=False)
+    # Make up for the last sec
+    dotFix.draw()
+    frame_timing.record(myWin.flip(), frame_idx, STATIC)
+    core.wait(1.0)
+
+    # Frame intervals of the run, next to the stimulus schedule, and a
+    # summary of dropped frames in the log
+    frame_timing.save(os.path.join(outFolderName,
+                                   'frame_timing_Run%s.npy' % expInfo['run']))
+    timing_summary = frame_timing.summary()
+    for key in ['n_frames', 'n_dropped', 'median_interval_ms', 'max_jitter_ms',
+                'histogram', 'dropped_per_tr']:
+        logFile.write('FrameTiming_' + key + '=' + str(timing_summary[key])
+                      + '\n')
+    if timing_summary['n_dropped']:
+        logging.warning('%d dropped frames in %d TRs, worst jitter %.2f ms' % (
+            timing_summary['n_dropped'], len(timing_summary['dropped_per_tr']),
+            timing_summary['max_jitter_ms']))
+
+    # Stop listening and keep the driver timestamps of every scanner trigger
+    trigger_listener.stop()
+    event_journal.log('run_end', core.getTime(), frame_idx)
+    event_journal.close()
+    logFile.write('Triggers=' + str(len(trigger_listener.trigger_times))
+                  + '\n')
+    logFile.write('RunCompleted=True\n')
+    np.savetxt(os.path.join(outFolderName,
+                            'trigger_times_Run%s.csv' % expInfo['run']),
+               trigger_listener.trigger_times, fmt='%.6f', header='t_down',
+               comments='')
+
+    # Trigger-to-photon latency per TR and its distribution
+    latency_tracer.save(os.path.join(
+        outFolderName, 'trigger_latency_Run%s.csv' % expInfo['run']))
+    latency_summary = latency_tracer.summary()
+    with open(os.path.join(outFolderName, 'trigger_latency_summary_Run%s.json'
+                           % expInfo['run']), 'w') as f:
+        json.dump(latency_summary, f, indent=4)
+    for key in ['trigger_to_flip_median_ms', 'trigger_to_flip_p95_ms',
+                'trigger_to_flip_max_ms', 'n_late']:
+        logFile.write('Latency_' + key + '=' + str(latency_summary[key]) + '\n')
+    if latency_summary['n_late']:
+        logging.warning('%d of %d stimulus onsets later than two frames after '
+                        'the trigger' % (latency_summary['n_late'],
+                                         latency_summary['n_traced']))
+
+
+for run_n, run in enumerate(session_runs):
+    if run_n > 0:
+        # The window, stimuli and tracker link stay up; only the log,
+        # schedule and EDF change, and a drift check replaces calibration
+        start_run(run)
+        drift_check()
+
+    # put tracker in idle/offline mode before recording
+    el_tracker.setOfflineMode()
+    # Start recording
+    # arguments: sample_to_file, events_to_file, sample_over_link,
+    # event_over_link (1-yes, 0-no)
+    try:
+        el_tracker.startRecording(1, 1, 1, 1)
+    except RuntimeError as error:
+        print("ERROR:", error)
+        abort_trial()
+
+    # Drain the gaze samples sent over the link while the run is recorded
+    link_reader = None
+    if read_link_samples and not dummy_mode:
+        sample_ring = SampleRing(
+            capacity=1 << 16,
+            spill_path=os.path.join(outFolderName, 'link_samples_Run%s.npy'
+                                    % expInfo['run']),
+            spill_capacity=int(link_spill_seconds * link_sample_rate))
+        link_reader = LinkSampleReader(el_tracker, sample_ring,
+                                       sample_rate=link_sample_rate,
+                                       lock=edf_transfer.link_lock)
+        link_reader.start()
+
+    run_scan()
+
+    if link_reader is not None:
+        link_reader.stop()
+        logFile.write('LinkSamples=' + str(sample_ring.n_written) + '\n')
+        logFile.write('LinkSampleGaps=' + str(link_reader.n_gaps) + '\n')
+        if link_reader.n_gaps or sample_ring.n_spill_lost:
+            logging.warning('%d gaps in the link samples, %d samples not '
+                            'saved' % (link_reader.n_gaps,
+                                       sample_ring.n_spill_lost))
+
+    # EYETRACKER STOP RECORDING AND SAVE EDF OF THE RUN
+    os.chdir(parentDir)
+    el_tracker.stopRecording()
+    if el_tracker.isConnected():
+        close_edf()
+    finish_frame_capture()
 
-# End fixation 
-show_fixation_until_triggers(myWin, dotFix, num_triggers=16-1, # trigger at the end of each volume should -1 other wise it will be 17
-                             save_frames=(expInfo['mode'] == 'outputMovie'),
-                             outFolder=PNGFolderName)
-# Make up for the last sec
-dotFix.draw()
-myWin.flip()
-core.wait(1.0)
+    endText.draw()
+    myWin.flip()
+    core.wait(3.0)
 
 # Byebye
-# EYETRACKER CLOSE DISPLAY AND SAVE EDF
-os.chdir(parentDir)
-el_tracker.stopRecording()
 terminate_task()
-
-endText.draw()
-myWin.flip()
-core.wait(3.0)
-myWin.close()
-core.quit()
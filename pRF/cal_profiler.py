@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Opt-in latency profiler for the pylink custom display callbacks.
+
+CallbackProfiler replaces the callbacks of an EyeLinkCoreGraphicsPsychoPy
+instance (draw_image_line, get_input_key, draw_cal_target, ...) and the
+flip() of its window with thin wrappers. Every callback call is stored in a
+preallocated NumPy ring buffer as (callback, start time, wall time, flips),
+and per-callback totals are kept separately, so counts stay exact after the
+ring has wrapped. Wall times are inclusive of nested callbacks (e.g.
+draw_cal_target -> clear_cal_display); flips are charged to the innermost
+callback that issued them. The flip() wrapper is only installed while a
+callback is running, so flips of the stimulus loop are not touched.
+
+summary() formats one row per callback: calls, total/mean/p95/max wall time
+and flips, which makes redundant flips and slow paths stand out.
+"""
+
+import time
+import numpy as np
+
+# the callbacks pylink calls on a custom display
+CALLBACKS = ('setup_cal_display', 'clear_cal_display', 'exit_cal_display',
+             'record_abort_hide', 'erase_cal_target', 'draw_cal_target',
+             'play_beep', 'get_mouse_state', 'get_input_key',
+             'exit_image_display', 'alert_printf', 'setup_image_display',
+             'image_title', 'draw_image_line', 'set_image_palette',
+             'draw_line', 'draw_lozenge')
+
+record_dtype = np.dtype([('callback', np.int16), ('t_start', np.float64),
+                         ('wall', np.float64), ('flips', np.int32)])
+
+
+class CallbackProfiler(object):
+    def __init__(self, capacity=65536, callbacks=CALLBACKS):
+        """ Constructor
+
+        capacity: calls kept in the ring buffer, older calls are overwritten
+        callbacks: names of the methods to instrument
+        """
+        self.callbacks = list(callbacks)
+        self._ring = np.zeros(capacity, dtype=record_dtype)
+        self._n = 0  # calls recorded, including overwritten ones
+        self._calls = np.zeros(len(self.callbacks), dtype=np.int64)
+        self._wall = np.zeros(len(self.callbacks), dtype=np.float64)
+        self._max = np.zeros(len(self.callbacks), dtype=np.float64)
+        self._flips = np.zeros(len(self.callbacks), dtype=np.int64)
+        self._stack = []  # flip counters of the callbacks in progress
+        self._target = None
+        self._win = None
+        self._profiled_flip = None
+        self._report_index = None
+        self._report = None
+
+    def _wrap(self, index, method):
+        def profiled(*args, **kwargs):
+            if not self._stack:
+                self._win.flip = self._profiled_flip
+            self._stack.append(0)
+            t0 = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                wall = time.perf_counter() - t0
+                flips = self._stack.pop()
+                if not self._stack and self._win is not None:
+                    self._win.__dict__.pop('flip', None)
+                self._record(index, t0, wall, flips)
+                if index == self._report_index and not self._stack:
+                    self._report(self.summary())
+        profiled.__name__ = method.__name__
+        profiled.__doc__ = method.__doc__
+        return profiled
+
+    def _wrap_flip(self, flip):
+        def profiled_flip(*args, **kwargs):
+            if self._stack:
+                self._stack[-1] += 1
+            return flip(*args, **kwargs)
+        return profiled_flip
+
+    def _record(self, index, t0, wall, flips):
+        rec = self._ring[self._n % len(self._ring)]
+        rec['callback'] = index
+        rec['t_start'] = t0
+        rec['wall'] = wall
+        rec['flips'] = flips
+        self._n += 1
+        self._calls[index] += 1
+        self._wall[index] += wall
+        self._flips[index] += flips
+        if wall > self._max[index]:
+            self._max[index] = wall
+
+    def attach(self, display, win, report_after=None, report=print):
+        """ Instrument the callbacks of display and the flips of win
+
+        report_after: callback name; after every call of it the summary is
+            passed to report, e.g. 'exit_cal_display'
+        report: function taking the summary text
+        """
+
+        if self._target is not None:
+            raise RuntimeError('profiler is already attached')
+        for index, name in enumerate(self.callbacks):
+            setattr(display, name, self._wrap(index, getattr(display, name)))
+        # installed on win by the callback wrappers while they run
+        self._profiled_flip = self._wrap_flip(win.flip)
+        self._target = display
+        self._win = win
+        if report_after is not None:
+            self._report_index = self.callbacks.index(report_after)
+        self._report = report
+
+    def detach(self):
+        """ Restore the original methods """
+
+        if self._target is None:
+            return
+        for name in self.callbacks:
+            # the wrappers live in the instance dict, the class has the method
+            self._target.__dict__.pop(name, None)
+        self._win.__dict__.pop('flip', None)
+        self._target = None
+        self._win = None
+        self._profiled_flip = None
+        self._report_index = None
+
+    def reset(self):
+        """ Forget all recorded calls """
+
+        self._n = 0
+        self._ring[:] = 0
+        self._calls[:] = 0
+        self._wall[:] = 0
+        self._max[:] = 0
+        self._flips[:] = 0
+
+    def records(self):
+        """ Calls still in the ring buffer, oldest first """
+
+        n = min(self._n, len(self._ring))
+        start = self._n % len(self._ring) if self._n > len(self._ring) else 0
+        return np.roll(self._ring[:n], -start)
+
+    def summary(self):
+        """ Table of the callbacks called since the last reset, slowest
+        (by total wall time) first """
+
+        recs = self.records()
+        lines = ['%-20s %8s %10s %9s %9s %9s %7s %7s' % (
+            'callback', 'calls', 'total ms', 'mean ms', 'p95 ms', 'max ms',
+            'flips', 'flip/c')]
+        for index in np.argsort(-self._wall):
+            calls = self._calls[index]
+            if calls == 0:
+                continue
+            walls = recs['wall'][recs['callback'] == index]
+            p95 = np.percentile(walls, 95) if len(walls) else np.nan
+            lines.append('%-20s %8d %10.1f %9.3f %9.3f %9.3f %7d %7.2f' % (
+                self.callbacks[index], calls, self._wall[index] * 1000,
+                self._wall[index] / calls * 1000, p95 * 1000,
+                self._max[index] * 1000, self._flips[index],
+                self._flips[index] / float(calls)))
+        return '\n'.join(lines)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batch converter from outputMovie PNG archives to design-matrix stacks.
+
+Walks every *_SubjData/pRF/PNG/Run<run> folder (and PNG itself, where
+older sessions wrote their frames), decodes the frame_NNN.png files in a
+process pool, binarises them against the background grey, crops them to the
+aperture and optionally downsamples them, and writes one frame stack
+(frame_stack.py) per folder to *_SubjData/pRF/Stack/PNG/Run<run>
+(Stack/PNG).
+
+Folders whose PNGs have not changed since the last conversion (same names,
+sizes and modification times, same options) are skipped, so nightly re-runs
+only convert new archives.
+
+Usage:
+    python convert_png_archives.py [project_folder] [--grid 101] [--jobs N]
+"""
+
+import os
+import glob
+import json
+import hashlib
+import argparse
+import functools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from frame_stack import FrameStackWriter, rgb_to_mask
+
+SIGNATURE_FILE = 'source.json'
+
+
+def decode_frame(png_file, background):
+    """ Decode one PNG into a bit-packed foreground mask
+
+    Returns:
+        (packed mask, mask width, foreground bounding box or None)
+    """
+    # the captures are grey/white only, so decode straight to luminance
+    frame = np.asarray(Image.open(png_file).convert('L'))
+    mask = rgb_to_mask(frame, background)
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    bbox = None
+    if len(rows):
+        bbox = (rows[0], rows[-1] + 1, cols[0], cols[-1] + 1)
+    return np.packbits(mask, axis=-1), mask.shape[1], bbox
+
+
+def aperture_crop(shape, bboxes, radius_px=None):
+    """ Square crop around the screen centre that holds the aperture
+
+    shape: (height, width) of the frames
+    bboxes: foreground bounding boxes of the frames (None for blank ones)
+    radius_px: aperture radius in pixels; derived from the union of the
+        bounding boxes when None (the bars sweep the whole aperture)
+    """
+    cy, cx = shape[0] / 2.0, shape[1] / 2.0
+    if radius_px is None:
+        bboxes = np.array([b for b in bboxes if b is not None], dtype=float)
+        if len(bboxes) == 0:
+            raise ValueError('no foreground in any frame')
+        radius_px = max(cy - bboxes[:, 0].min(), bboxes[:, 1].max() - cy,
+                        cx - bboxes[:, 2].min(), bboxes[:, 3].max() - cx)
+    r = int(np.ceil(radius_px))
+    return (int(round(cy)) - r, int(round(cy)) + r,
+            int(round(cx)) - r, int(round(cx)) + r)
+
+
+def source_signature(png_files, options):
+    """ Hash of the PNG names, sizes and mtimes and the conversion options """
+
+    sig = hashlib.sha1(json.dumps(options, sort_keys=True).encode())
+    for png_file in png_files:
+        st = os.stat(png_file)
+        sig.update(('%s %d %d\n' % (os.path.basename(png_file), st.st_size,
+                                    st.st_mtime_ns)).encode())
+    return sig.hexdigest()
+
+
+def convert_folder(png_folder, out_folder, pool, background, grid=None,
+                   radius_px=None, force=False):
+    """ Convert one PNG folder; returns False if it was up to date """
+
+    png_files = sorted(glob.glob(os.path.join(png_folder, 'frame_*.png')))
+    if not png_files:
+        return False
+    options = {'background': background, 'grid': grid,
+               'radius_px': radius_px}
+    signature = source_signature(png_files, options)
+    signature_file = os.path.join(out_folder, SIGNATURE_FILE)
+    if not force and os.path.exists(signature_file):
+        with open(signature_file) as f:
+            if json.load(f).get('signature') == signature:
+                return False
+
+    decoded = list(pool.map(functools.partial(decode_frame,
+                                              background=background),
+                            png_files, chunksize=8))
+    width = decoded[0][1]
+    height = decoded[0][0].shape[0]
+    y0, y1, x0, x1 = aperture_crop((height, width),
+                                   [bbox for _, _, bbox in decoded],
+                                   radius_px)
+
+    stack = FrameStackWriter(out_folder, capacity=len(png_files))
+    for png_file, (packed, w, _) in zip(png_files, decoded):
+        mask = np.unpackbits(packed, axis=-1, count=w).astype(bool)
+        # crop, padding with background where the square leaves the screen
+        crop = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+        sy0, sx0 = max(y0, 0), max(x0, 0)
+        sy1, sx1 = min(y1, mask.shape[0]), min(x1, mask.shape[1])
+        crop[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = mask[sy0:sy1, sx0:sx1]
+        if grid is not None:
+            crop = np.asarray(Image.fromarray(crop.astype(np.uint8) * 255)
+                              .resize((grid, grid), Image.BOX)) > 127
+        tr = int(os.path.splitext(png_file)[0].rsplit('_', 1)[-1])
+        stack.append(crop, tr)
+    stack.close()
+
+    with open(signature_file, 'w') as f:
+        json.dump({'signature': signature, 'source': png_folder,
+                   'crop': [y0, y1, x0, x1]}, f)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert outputMovie PNG archives to design-matrix stacks')
+    parser.add_argument('root', nargs='?',
+                        default=os.path.dirname(os.path.dirname(
+                            os.path.abspath(__file__))),
+                        help='folder holding the *_SubjData folders')
+    parser.add_argument('--grid', type=int, default=None,
+                        help='downsample the aperture to grid x grid pixels')
+    parser.add_argument('--background', type=float, default=-0.5,
+                        help='backColor of the run, PsychoPy rgb (-1 to 1)')
+    parser.add_argument('--radius-px', type=float, default=None,
+                        help='aperture radius in pixels (default: detect)')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='worker processes (default: all cores)')
+    parser.add_argument('--force', action='store_true',
+                        help='convert folders that are already up to date')
+    args = parser.parse_args()
+
+    background = (args.background + 1) / 2.0 * 255
+    # (pRF folder, PNG[/Run<run>]) -> pRF folder/Stack/PNG[/Run<run>]
+    png_folders = []
+    for png_root in sorted(glob.glob(os.path.join(args.root, '*_SubjData',
+                                                  'pRF', 'PNG'))):
+        pRF_folder = os.path.dirname(png_root)
+        for png_folder in [png_root] + sorted(
+                glob.glob(os.path.join(png_root, 'Run*'))):
+            png_folders.append((pRF_folder, png_folder))
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        for pRF_folder, png_folder in png_folders:
+            if not glob.glob(os.path.join(png_folder, 'frame_*.png')):
+                continue
+            out_folder = os.path.join(pRF_folder, 'Stack',
+                                      os.path.relpath(png_folder, pRF_folder))
+            if convert_folder(png_folder, out_folder, pool, background,
+                              grid=args.grid, radius_px=args.radius_px,
+                              force=args.force):
+                print('%s -> %s' % (png_folder, out_folder))
+            else:
+                print('%s: up to date' % png_folder)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Headless renderer for the pRF design matrix.
+
+Rebuilds the binary stimulus apertures shown by bar.py directly from the
+stimulus schedule and the bar/aperture geometry, without a PsychoPy window,
+trigger box or eye tracker. The output is a boolean (n_TR, H, W) array that
+covers the aperture bounding box, including the fixation blocks before and
+after the bar sweeps.
+
+Usage (rebuild every run of every subject below the project folder):
+    python design_matrix.py [project_folder] [--n-pix 101]
+"""
+
+import os
+import glob
+import argparse
+import numpy as np
+import pandas as pd
+from stim_schedule import load_stim_schedule, n_lead_trs, n_tail_trs
+
+# === Geometry, matching bar.py ===
+bar_length = 10.0       # degrees
+bar_width = 0.9         # degrees
+aperture_radius = 5.0   # degrees
+
+
+def render_design_matrix(orientations, positions, bar_length=bar_length,
+                         bar_width=bar_width, aperture_radius=aperture_radius,
+                         n_pix=101, n_lead=n_lead_trs, n_tail=n_tail_trs):
+    """
+    Rasterise the bar apertures of a run into a binary design matrix.
+
+    Args:
+        orientations: bar orientation per TR in degrees (PsychoPy 'ori',
+            clockwise)
+        positions: (n, 2) bar centre per TR in degrees
+        bar_length, bar_width: bar size in degrees
+        aperture_radius: radius of the circular aperture in degrees
+        n_pix: number of pixels along each side of the aperture grid
+        n_lead, n_tail: number of fixation-only TRs before/after the bars
+
+    Returns:
+        bool array of shape (n_lead + n + n_tail, n_pix, n_pix); row 0 is the
+        top of the screen, column 0 the left.
+    """
+    orientations = np.asarray(orientations, dtype=float).ravel()
+    positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+    if len(orientations) != len(positions):
+        raise ValueError('orientations and positions differ in length')
+
+    # Only a handful of (ori, x, y) combinations exist, render each once
+    params = np.column_stack([orientations, positions]).round(9)
+    unique_params, inverse = np.unique(params, axis=0, return_inverse=True)
+
+    coords = np.linspace(-aperture_radius, aperture_radius, n_pix,
+                         dtype=np.float32)
+    x = coords[np.newaxis, np.newaxis, :]
+    y = coords[::-1][np.newaxis, :, np.newaxis]
+
+    theta = np.deg2rad(unique_params[:, 0]).astype(np.float32)
+    cos_t = np.cos(theta)[:, np.newaxis, np.newaxis]
+    sin_t = np.sin(theta)[:, np.newaxis, np.newaxis]
+    dx = x - unique_params[:, 1, np.newaxis, np.newaxis].astype(np.float32)
+    dy = y - unique_params[:, 2, np.newaxis, np.newaxis].astype(np.float32)
+
+    # A clockwise rotation by ori maps the bar's long axis to (cos, -sin)
+    along = dx * cos_t - dy * sin_t
+    across = dx * sin_t + dy * cos_t
+    unique_frames = ((np.abs(along) <= bar_length / 2.0) &
+                     (np.abs(across) <= bar_width / 2.0) &
+                     (x**2 + y**2 <= aperture_radius**2))
+
+    design = np.zeros((n_lead + len(orientations) + n_tail, n_pix, n_pix),
+                      dtype=bool)
+    design[n_lead:n_lead + len(orientations)] = unique_frames[inverse.ravel()]
+    return design
+
+
+def design_matrix_from_schedule(stim_schedule, **kwargs):
+    """
+    Render the design matrix of a schedule.
+
+    Args:
+        stim_schedule: structured array from stim_schedule.py, a path to a
+            saved schedule (.npy or .csv, including the legacy CSVs), or a
+            list of dicts / DataFrame with 'orientation' and 'position'
+        **kwargs: forwarded to render_design_matrix
+    """
+    if isinstance(stim_schedule, str):
+        stim_schedule = load_stim_schedule(stim_schedule)
+    if isinstance(stim_schedule, np.ndarray):
+        orientations = stim_schedule['orientation']
+        positions = np.column_stack([stim_schedule['pos_x'],
+                                     stim_schedule['pos_y']])
+    else:
+        if isinstance(stim_schedule, pd.DataFrame):
+            stim_schedule = stim_schedule.to_dict('records')
+        orientations = [step['orientation'] for step in stim_schedule]
+        positions = [step['position'] for step in stim_schedule]
+    return render_design_matrix(orientations, positions, **kwargs)
+
+
+def find_schedules(root):
+    """ Saved schedules of every subject below root, preferring the .npy
+    file where both a .npy and a .csv exist"""
+
+    pattern = os.path.join(root, '*_SubjData', 'pRF', 'Output',
+                           'stim_schedule*')
+    schedules = {}
+    for path in sorted(glob.glob(pattern)):
+        stem, ext = os.path.splitext(path)
+        if ext == '.npy' or (ext == '.csv' and stem not in schedules):
+            schedules[stem] = path
+    return [schedules[stem] for stem in sorted(schedules)]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Rebuild pRF design matrices for every subject and run')
+    parser.add_argument('root', nargs='?',
+                        default=os.path.dirname(os.path.dirname(
+                            os.path.abspath(__file__))),
+                        help='folder holding the *_SubjData folders')
+    parser.add_argument('--n-pix', type=int, default=101,
+                        help='pixels along each side of the aperture grid')
+    args = parser.parse_args()
+
+    for schedule_file in find_schedules(args.root):
+        design = design_matrix_from_schedule(schedule_file, n_pix=args.n_pix)
+        stem = os.path.splitext(os.path.basename(schedule_file))[0]
+        out_file = os.path.join(os.path.dirname(schedule_file),
+                                stem.replace('stim_schedule', 'design_matrix')
+                                + '.npy')
+        np.save(out_file, design)
+        print('%s -> %s %s' % (schedule_file, out_file, design.shape))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-display geometry and refresh-rate profiles.
+
+display_profiles.json holds one entry per display (scanner room, laptop):
+viewing distance and width in cm and resolution in pixels. bar.py offers
+every profile in its start dialog, so a new room only needs a new entry
+here. The file is under version control and is only read.
+
+Measured refresh rates are machine specific. They are cached with the time
+they were measured in display_profiles.local.json (not tracked by git),
+whose entries are merged into the profiles as refresh_rate and
+refresh_measured. A cached refresh rate is reused until it is older than
+max_age_days; measuring it again rewrites the local entry.
+"""
+
+import os
+import json
+import datetime
+
+default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'display_profiles.json')
+default_local_path = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'display_profiles.local.json')
+
+REQUIRED_KEYS = ('distance_cm', 'width_cm', 'pix_w', 'pix_h')
+
+
+def _read_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_profiles(path=default_path, local_path=default_local_path):
+    """ Read the display profiles and the locally cached refresh rates
+
+    Returns:
+        dict of display name -> profile dict, in file order, with
+        refresh_rate and refresh_measured filled in (None if not cached)
+    """
+    with open(path) as f:
+        profiles = json.load(f)
+    cache = _read_json(local_path, {})
+    for name, profile in profiles.items():
+        missing = [key for key in REQUIRED_KEYS if key not in profile]
+        if missing:
+            raise ValueError('display profile %r lacks %s' % (
+                name, ', '.join(missing)))
+        cached = cache.get(name, {})
+        profile['refresh_rate'] = cached.get('refresh_rate')
+        profile['refresh_measured'] = cached.get('refresh_measured')
+    return profiles
+
+
+def cached_refresh_rate(profile, max_age_days=30):
+    """ The cached refresh rate of a profile, or None if it was never
+    measured or the measurement is older than max_age_days """
+
+    if profile.get('refresh_rate') is None or not profile.get(
+            'refresh_measured'):
+        return None
+    measured = datetime.datetime.fromisoformat(profile['refresh_measured'])
+    if datetime.datetime.now() - measured > datetime.timedelta(
+            days=max_age_days):
+        return None
+    return profile['refresh_rate']
+
+
+def store_refresh_rate(name, refresh_rate, path=default_path,
+                       local_path=default_local_path):
+    """ Cache a measured refresh rate of display name in the local file
+
+    Returns:
+        the profile of display name with the new refresh rate
+    """
+    cache = _read_json(local_path, {})
+    cache[name] = {
+        'refresh_rate': round(float(refresh_rate), 3),
+        'refresh_measured': datetime.datetime.now().isoformat(
+            timespec='seconds')}
+    # written atomically, a crash never leaves half a file behind
+    tmp = local_path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=4)
+        f.write('\n')
+    os.replace(tmp, local_path)
+    return load_profiles(path, local_path)[name]
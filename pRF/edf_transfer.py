@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Background retrieval of EDF files from the EyeLink Host PC.
+
+EdfTransfer downloads the EDF of a finished run on a worker thread, so the
+next run can be set up (log, schedule, stimuli) while the file comes in.
+Every download goes to <local>.part and is only moved into place after its
+size matches the size reported by receiveDataFile(); that size is the only
+check against the Host. The SHA-256 of the downloaded file is then written
+to <local>.sha256 (sha256sum format), so later copies of the local file can
+be checked with verify_sidecar(). Failed downloads are retried.
+
+pylink is not thread safe: nothing else may use the link while a file is
+transferred. Hold link_lock around tracker calls made during a transfer,
+or call wait() before opening the next EDF.
+
+Run this file to transfer a generated file through a local stand-in for
+the tracker:
+    python edf_transfer.py [size_in_MB]
+"""
+
+import os
+import sys
+import time
+import queue
+import hashlib
+import tempfile
+import threading
+import collections
+
+TransferResult = collections.namedtuple(
+    'TransferResult', ['host_file', 'local_file', 'ok', 'size', 'sha256',
+                       'attempts', 'error'])
+
+
+def sha256_of(path, chunk_size=1 << 20):
+    """ Hex SHA-256 of a file """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def verify_sidecar(local_file):
+    """ True if local_file still matches its .sha256 sidecar """
+
+    with open(local_file + '.sha256') as f:
+        expected = f.read().split()[0]
+    return sha256_of(local_file) == expected
+
+
+class EdfTransfer(object):
+    def __init__(self, tracker, retries=3, retry_delay=2.0, progress=None,
+                 poll_interval=0.25):
+        """ Constructor
+
+        tracker: pylink.EyeLink (or anything with receiveDataFile)
+        retries: attempts per file after the first one
+        retry_delay: seconds between attempts
+        progress: called as progress(host_file, bytes_received) from the
+            worker while a file downloads, None to stay quiet
+        poll_interval: seconds between progress reports
+        """
+        self._tracker = tracker
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._progress = progress
+        self._poll_interval = poll_interval
+        self._jobs = queue.Queue()
+        self.link_lock = threading.Lock()
+        self.results = []
+        # (host_file, bytes received) of the download in progress
+        self.current = None
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='EdfTransfer')
+        self._thread.start()
+
+    def submit(self, host_file, local_file):
+        """ Queue a download; the EDF must be closed on the Host """
+
+        self._jobs.put((host_file, local_file))
+
+    def wait(self, timeout=None):
+        """ Block until all queued downloads are done
+
+        Returns:
+            False if the timeout expired first
+        """
+        if timeout is None:
+            self._jobs.join()
+            return True
+        deadline = time.monotonic() + timeout
+        while self._jobs.unfinished_tasks:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(min(0.01, timeout))
+        return True
+
+    def close(self):
+        """ Finish the queued downloads and stop the worker
+
+        Returns:
+            the TransferResults of all downloads
+        """
+        self._jobs.put(None)
+        self._thread.join()
+        return self.results
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                if job is None:
+                    return
+                result = self._transfer(*job)
+                self.results.append(result)
+                if not result.ok:
+                    print('ERROR: EDF transfer of %s failed after %d '
+                          'attempts: %s' % (result.host_file,
+                                            result.attempts, result.error))
+            finally:
+                self._jobs.task_done()
+
+    def _receive(self, host_file, part_file):
+        """ One download attempt with progress reports
+
+        Returns:
+            size reported by receiveDataFile
+        """
+        outcome = {}
+
+        def receive():
+            try:
+                with self.link_lock:
+                    outcome['size'] = self._tracker.receiveDataFile(
+                        host_file, part_file)
+            except Exception as err:
+                outcome['error'] = err
+
+        receiver = threading.Thread(target=receive, daemon=True)
+        receiver.start()
+        while receiver.is_alive():
+            receiver.join(self._poll_interval)
+            received = os.path.getsize(part_file) \
+                if os.path.exists(part_file) else 0
+            self.current = (host_file, received)
+            if self._progress is not None:
+                self._progress(host_file, received)
+        self.current = None
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome['size']
+
+    def _transfer(self, host_file, local_file):
+        part_file = local_file + '.part'
+        folder = os.path.dirname(local_file)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        error = None
+        for attempt in range(1, self._retries + 2):
+            if attempt > 1:
+                time.sleep(self._retry_delay)
+            if os.path.exists(part_file):
+                os.remove(part_file)
+            try:
+                size = self._receive(host_file, part_file)
+            except Exception as err:
+                error = str(err)
+                continue
+            # pylink: file size on success, 0 if cancelled, < 0 on error
+            if size is None or size <= 0:
+                error = 'receiveDataFile returned %s' % size
+                continue
+            local_size = os.path.getsize(part_file)
+            if local_size != size:
+                error = 'received %d of %d bytes' % (local_size, size)
+                continue
+            digest = sha256_of(part_file)
+            os.replace(part_file, local_file)
+            with open(local_file + '.sha256', 'w') as f:
+                f.write('%s  %s\n' % (digest, os.path.basename(local_file)))
+            return TransferResult(host_file, local_file, True, size, digest,
+                                  attempt, None)
+        return TransferResult(host_file, local_file, False, None, None,
+                              self._retries + 1, error)
+
+
+class _LocalTracker(object):
+    """ Stand-in for pylink.EyeLink serving files from a folder, copied in
+    chunks at a limited rate; the first n_failures calls fail """
+
+    def __init__(self, folder, rate=20e6, n_failures=1):
+        self._folder = folder
+        self._rate = rate
+        self._n_failures = n_failures
+
+    def receiveDataFile(self, src, dest):
+        path = os.path.join(self._folder, src)
+        if self._n_failures > 0:
+            self._n_failures -= 1
+            with open(dest, 'wb') as f:
+                f.write(b'\0' * 1024)
+            raise RuntimeError('link reset during transfer')
+        chunk = 1 << 18
+        with open(path, 'rb') as fin, open(dest, 'wb') as fout:
+            for block in iter(lambda: fin.read(chunk), b''):
+                fout.write(block)
+                fout.flush()
+                time.sleep(len(block) / self._rate)
+        return os.path.getsize(path)
+
+
+def main():
+    size_mb = float(sys.argv[1]) if len(sys.argv) > 1 else 20.0
+    with tempfile.TemporaryDirectory() as tmp:
+        host = os.path.join(tmp, 'host')
+        local = os.path.join(tmp, 'local')
+        os.makedirs(host)
+        with open(os.path.join(host, 'RF_run01.EDF'), 'wb') as f:
+            f.write(os.urandom(int(size_mb * 1e6)))
+
+        def progress(host_file, received):
+            print('%s: %.1f MB' % (host_file, received / 1e6))
+
+        transfer = EdfTransfer(_LocalTracker(host), retry_delay=0.1,
+                               progress=progress)
+        t0 = time.monotonic()
+        transfer.submit('RF_run01.EDF', os.path.join(local, 'RF_run01.EDF'))
+        # the main thread stays free while the file comes in
+        while not transfer.wait(timeout=0.5):
+            pass
+        result = transfer.close()[0]
+        print(result._replace(sha256=result.sha256[:12] + '...'))
+        print('transfer %.2f s, matches source: %s, sidecar ok: %s' % (
+            time.monotonic() - t0,
+            result.sha256 == sha256_of(os.path.join(host, 'RF_run01.EDF')),
+            verify_sidecar(result.local_file)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Binary event journal for the stimulus loop.
+
+Events are (time, event type, TR index, value) rows written into a
+preallocated NumPy record array: no string formatting and no I/O in the
+frame loop. flush() appends the rows collected so far to the journal file
+in one write; call it where the screen is static (fixation) or at the end
+of the run. A full buffer is flushed on its own.
+
+The journal file holds the raw records; a JSON sidecar (<path>.json) names
+the fields and the event types, and load_journal() reads both back.
+"""
+
+import json
+import numpy as np
+
+EVENT_TYPES = ('run_start', 'trigger', 'response', 'bar_onset',
+               'fixation_onset', 'escape', 'run_end')
+
+journal_dtype = np.dtype([('t', np.float64), ('event', np.int16),
+                          ('tr_index', np.int32), ('value', np.float64)])
+
+
+class EventJournal(object):
+    def __init__(self, path, capacity=4096, event_types=EVENT_TYPES):
+        """ Constructor
+
+        path: journal file, overwritten
+        capacity: events buffered between flushes
+        event_types: names of the event types, stored as their index
+        """
+        self.path = path
+        self.event_types = list(event_types)
+        self._codes = dict((name, code)
+                           for code, name in enumerate(self.event_types))
+        self._buffer = np.zeros(capacity, dtype=journal_dtype)
+        self._n = 0
+        self.n_events = 0
+        with open(path + '.json', 'w') as f:
+            json.dump({'dtype': [[name, journal_dtype[name].str]
+                                 for name in journal_dtype.names],
+                       'event_types': self.event_types}, f)
+        self._file = open(path, 'wb')
+
+    def log(self, event, t, tr_index=-1, value=np.nan):
+        """ Record one event; event is a name from event_types """
+
+        if self._n == len(self._buffer):
+            self.flush()
+        rec = self._buffer[self._n]
+        rec['t'] = t
+        rec['event'] = self._codes[event]
+        rec['tr_index'] = tr_index
+        rec['value'] = value
+        self._n += 1
+        self.n_events += 1
+
+    def flush(self):
+        """ Append the buffered events to the journal file """
+
+        if self._n:
+            self._file.write(self._buffer[:self._n].tobytes())
+            self._file.flush()
+            self._n = 0
+
+    def close(self):
+        """ Flush and close the journal file """
+
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+
+def load_journal(path):
+    """ Read a journal back
+
+    Returns:
+        (records, event type names); records['event'] indexes the names
+    """
+    with open(path + '.json') as f:
+        meta = json.load(f)
+    dtype = np.dtype([(str(name), str(code)) for name, code in meta['dtype']])
+    return np.fromfile(path, dtype=dtype), meta['event_types']
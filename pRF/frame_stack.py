@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Single-file-per-run stack of captured design-matrix frames.
+
+A stack is a folder holding
+    frames.npy       (capacity, H, W) uint8 memmap of the distinct frames, or
+                     (capacity, H, ceil(W/8)) with binary masks bit-packed
+                     along the rows (8x smaller)
+    frame_index.npy  (capacity,) int32 memmap, row of frames.npy shown at
+                     every appended TR
+    tr_index.npy     (capacity,) int32 memmap, TR of every appended frame
+    stack.json       counts, frame shape and packing, rewritten after every
+                     appended frame, so a stack whose writer never got to
+                     close() (an aborted run) still opens with the frames
+                     appended so far; 'complete' is set by close()
+Frames are content-addressed: a frame whose hash was seen before is stored
+only as an index (a run has just 48 distinct bar frames and one blank one),
+so loaders build the full design matrix by fancy indexing. Appending is O(1),
+amortised when the preallocated capacity has to grow. FrameStack reads
+frames back lazily, so slicing a few TRs never touches the rest of the file.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+
+
+def rgb_to_mask(frame, background, foreground=255):
+    """ Binarise an (h, w, 3) RGB or (h, w) grey uint8 capture of the white
+    bar
+
+    background: grey level (0-255) of the window background
+    foreground: grey level of the bar
+    """
+    frame = np.asarray(frame)
+    if frame.ndim == 3:
+        frame = frame.mean(axis=-1)
+    return frame > (background + foreground) / 2.0
+
+
+class FrameStackWriter(object):
+    def __init__(self, path, capacity=1024, packbits=True, dedup=True):
+        """ Constructor
+
+        path: stack folder, created if needed
+        capacity: number of frames to preallocate
+        packbits: store frames as bit-packed boolean masks
+        dedup: store identical frames only once
+        """
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._capacity = capacity
+        # distinct frames are few, start small and grow on demand
+        self._unique_capacity = min(capacity, 64) if dedup else capacity
+        self._packbits = packbits
+        self._dedup = dedup
+        self._frame_shape = None
+        self._row_shape = None
+        self._frames = None
+        self._frame_index = None
+        self._tr_index = None
+        self._hashes = {}
+        self.n_frames = 0
+        self.n_unique = 0
+        self._write_meta(complete=False)
+
+    def _open(self, name, shape, dtype):
+        return np.lib.format.open_memmap(os.path.join(self.path, name),
+                                         mode='w+', dtype=dtype, shape=shape)
+
+    def _reopen(self, name, old, n, capacity):
+        """ Recreate a memmap with a larger capacity, keeping n rows """
+
+        kept = np.array(old[:n])
+        dtype, row_shape = old.dtype, old.shape[1:]
+        del old
+        new = self._open(name, (capacity,) + row_shape, dtype)
+        new[:n] = kept
+        return new
+
+    def append(self, frame, tr_index):
+        """ Add one (H, W) mask (bool, or uint8 if not bit-packed) """
+
+        frame = np.asarray(frame)
+        if self._frames is None:
+            self._frame_shape = frame.shape
+            self._row_shape = frame.shape
+            if self._packbits:
+                self._row_shape = (frame.shape[0], (frame.shape[1] + 7) // 8)
+            self._frames = self._open('frames.npy', (self._unique_capacity,)
+                                      + self._row_shape, np.uint8)
+            self._frame_index = self._open('frame_index.npy',
+                                           (self._capacity,), np.int32)
+            self._tr_index = self._open('tr_index.npy', (self._capacity,),
+                                        np.int32)
+        elif frame.shape != self._frame_shape:
+            raise ValueError('frame shape %s does not match the stack %s' % (
+                frame.shape, self._frame_shape))
+        if self._packbits:
+            frame = np.packbits(frame.astype(bool), axis=-1)
+        else:
+            frame = np.ascontiguousarray(frame, dtype=np.uint8)
+
+        row = None
+        if self._dedup:
+            key = hashlib.blake2b(frame.tobytes(), digest_size=16).digest()
+            row = self._hashes.get(key)
+        if row is None:
+            if self.n_unique == self._unique_capacity:
+                self._unique_capacity *= 2
+                self._frames = self._reopen('frames.npy', self._frames,
+                                            self.n_unique,
+                                            self._unique_capacity)
+            row = self.n_unique
+            self._frames[row] = frame
+            self.n_unique += 1
+            if self._dedup:
+                self._hashes[key] = row
+
+        if self.n_frames == self._capacity:
+            self._capacity *= 2
+            self._frame_index = self._reopen('frame_index.npy',
+                                             self._frame_index, self.n_frames,
+                                             self._capacity)
+            self._tr_index = self._reopen('tr_index.npy', self._tr_index,
+                                          self.n_frames, self._capacity)
+        self._frame_index[self.n_frames] = row
+        self._tr_index[self.n_frames] = tr_index
+        self.n_frames += 1
+        # the rows are in the memmaps, now count them
+        self._write_meta(complete=False)
+
+    def _write_meta(self, complete):
+        """ Write the stack description atomically """
+
+        meta = {'n_frames': self.n_frames,
+                'n_unique': self.n_unique,
+                'frame_shape': list(self._frame_shape or ()),
+                'packbits': self._packbits,
+                'complete': complete}
+        tmp = os.path.join(self.path, 'stack.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(self.path, 'stack.json'))
+
+    def close(self):
+        """ Flush the memmaps and write the final stack description """
+
+        if self._frames is not None:
+            self._frames.flush()
+            self._frame_index.flush()
+            self._tr_index.flush()
+        self._write_meta(complete=True)
+
+
+class FrameStack(object):
+    def __init__(self, path):
+        """ Open a stack written by FrameStackWriter, memory-mapped """
+
+        with open(os.path.join(path, 'stack.json')) as f:
+            meta = json.load(f)
+        n = meta['n_frames']
+        # stacks written before deduplication hold one row per frame
+        n_unique = meta.get('n_unique', n)
+        self.frame_shape = tuple(meta['frame_shape'])
+        self._packbits = meta['packbits']
+        # False for a stack whose run was aborted before close()
+        self.complete = meta.get('complete', True)
+        if n == 0:
+            # no frame was appended, the memmaps were never created
+            self.unique_frames = np.zeros((0, 0, 0), dtype=np.uint8)
+            self.tr_index = np.zeros(0, dtype=np.int32)
+            self.frame_index = np.zeros(0, dtype=np.int32)
+            return
+        self.unique_frames = np.load(os.path.join(path, 'frames.npy'),
+                                     mmap_mode='r')[:n_unique]
+        self.tr_index = np.load(os.path.join(path, 'tr_index.npy'),
+                                mmap_mode='r')[:n]
+        index_file = os.path.join(path, 'frame_index.npy')
+        if os.path.exists(index_file):
+            self.frame_index = np.load(index_file, mmap_mode='r')[:n]
+        else:
+            self.frame_index = np.arange(n)
+
+    def __len__(self):
+        return len(self.frame_index)
+
+    def __getitem__(self, key):
+        """ Frames by position in the stack, e.g. stack[10:20] """
+
+        frames = np.asarray(self.unique_frames[self.frame_index[key]])
+        if self._packbits:
+            frames = np.unpackbits(frames, axis=-1,
+                                   count=self.frame_shape[1]).astype(bool)
+        return frames
+
+    def design_matrix(self):
+        """ All frames: the distinct frames are unpacked once and expanded
+        by fancy indexing """
+
+        unique = np.asarray(self.unique_frames)
+        if self._packbits:
+            unique = np.unpackbits(unique, axis=-1,
+                                   count=self.frame_shape[1]).astype(bool)
+        return unique[np.asarray(self.frame_index)]
+
+    def by_tr(self, trs):
+        """ Frames of the given TR indices """
+
+        trs = np.asarray(trs)
+        n_trs = int(self.tr_index.max()) + 1 if len(self) else 0
+        outside = (trs < 0) | (trs >= n_trs)
+        if np.any(outside):
+            raise KeyError('TR %s not in the stack' % trs[outside].ravel()[0])
+        lookup = np.full(n_trs, -1)
+        lookup[self.tr_index] = np.arange(len(self))
+        positions = lookup[trs]
+        if np.any(positions < 0):
+            raise KeyError('TR %s not in the stack'
+                           % trs[positions < 0].ravel()[0])
+        return self[positions]
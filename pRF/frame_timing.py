@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Frame-interval recorder for the stimulus loop.
+
+Every flip is stored as (flip time, TR index, flicker phase) in a
+preallocated NumPy structured array, so recording is one row write per
+refresh. Static screens (fixation, flipped once and then held until the
+next trigger) are recorded with phase STATIC; the interval that follows
+them is a deliberate hold, not a dropped frame, and is left out of the
+statistics.
+
+A frame interval of k refresh periods (k rounded) means k - 1 dropped
+frames, charged to the TR of the late frame.
+"""
+
+import numpy as np
+
+STATIC = -1  # phase of frames that are held until the next trigger
+
+timing_dtype = np.dtype([('t_flip', np.float64), ('tr_index', np.int32),
+                         ('phase', np.int8)])
+
+
+class FrameTimingRecorder(object):
+    def __init__(self, refresh_rate, capacity=65536):
+        """ Constructor
+
+        refresh_rate: nominal refresh rate of the display in Hz
+        capacity: flips to preallocate, doubled if a run needs more
+        """
+        self.refresh_rate = float(refresh_rate)
+        self.frame_dur = 1.0 / self.refresh_rate
+        self._records = np.zeros(capacity, dtype=timing_dtype)
+        self.n_frames = 0
+
+    @classmethod
+    def from_file(cls, path, refresh_rate=None):
+        """ Recorder holding the flips saved by save(); refresh_rate None
+        estimates it from the median interval of the animated frames """
+
+        recs = np.load(path)
+        if refresh_rate is None:
+            dt = np.diff(recs['t_flip'])[recs['phase'][:-1] != STATIC]
+            refresh_rate = 1.0 / np.median(dt) if len(dt) else 60.0
+        timing = cls(refresh_rate, capacity=max(len(recs), 1))
+        timing._records[:len(recs)] = recs
+        timing.n_frames = len(recs)
+        return timing
+
+    def record(self, t_flip, tr_index, phase=STATIC):
+        """ Add one flip; t_flip as returned by win.flip() """
+
+        if self.n_frames == len(self._records):
+            self._records = np.concatenate(
+                [self._records, np.zeros_like(self._records)])
+        rec = self._records[self.n_frames]
+        rec['t_flip'] = t_flip
+        rec['tr_index'] = tr_index
+        rec['phase'] = phase
+        self.n_frames += 1
+
+    def records(self):
+        """ The recorded flips, oldest first """
+
+        return self._records[:self.n_frames]
+
+    def intervals(self):
+        """ Frame intervals in seconds and the TR of the later frame, for
+        all flips that do not follow a static frame """
+
+        recs = self.records()
+        dt = np.diff(recs['t_flip'])
+        valid = recs['phase'][:-1] != STATIC
+        return dt[valid], recs['tr_index'][1:][valid]
+
+    def summary(self):
+        """ Dropped frames per TR, interval histogram and worst jitter
+
+        Returns:
+            dict with n_frames, n_intervals, median_interval_ms, n_dropped,
+            dropped_per_tr ({TR: dropped frames}, TRs without drops left
+            out), histogram ({'1', '2', '3', '4+' refresh periods: count})
+            and max_jitter_ms (largest deviation of an interval from the
+            refresh period)
+        """
+        dt, trs = self.intervals()
+        periods = np.rint(dt / self.frame_dur).astype(int)
+        dropped = np.clip(periods - 1, 0, None)
+        per_tr = np.bincount(trs[dropped > 0], weights=dropped[dropped > 0])
+        hist = np.bincount(np.clip(periods, 1, 4), minlength=5)[1:]
+        return {
+            'n_frames': int(self.n_frames),
+            'n_intervals': int(len(dt)),
+            'median_interval_ms': float(np.median(dt) * 1000) if len(dt)
+            else float('nan'),
+            'n_dropped': int(dropped.sum()),
+            'dropped_per_tr': dict((int(tr), int(n))
+                                   for tr, n in enumerate(per_tr) if n),
+            'histogram': dict(zip(['1', '2', '3', '4+'],
+                                  [int(n) for n in hist])),
+            'max_jitter_ms': float(np.abs(dt - self.frame_dur).max() * 1000)
+            if len(dt) else float('nan'),
+        }
+
+    def save(self, path):
+        """ Write the flips to path (.npy) """
+
+        np.save(path, self.records())
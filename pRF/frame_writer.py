@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Background writer for frames captured during a run.
+
+Captured frames are handed to a bounded queue and encoded/written by worker
+threads, so PNG encoding and disk I/O never run on the flip/trigger path.
+The queue bound is the back-pressure: with policy 'block' submit() waits for
+a free slot (no frame is ever lost), with 'drop' the new frame is discarded
+and counted. close() flushes everything still queued.
+"""
+
+import queue
+import threading
+import numpy as np
+from PIL import Image
+
+
+def save_image(path, image):
+    """ Default save function: write a PIL image or an array to path """
+
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    image.save(path)
+
+
+class AsyncFrameWriter(object):
+    def __init__(self, save_fn=save_image, max_pending=64, policy='block',
+                 n_workers=2):
+        """ Constructor
+
+        save_fn: called as save_fn(target, frame) on a worker thread
+        max_pending: frames that may wait in the queue
+        policy: 'block' or 'drop', what submit() does when the queue is full
+        n_workers: number of writer threads
+        """
+        if policy not in ('block', 'drop'):
+            raise ValueError("policy must be 'block' or 'drop'")
+        self._save_fn = save_fn
+        self._policy = policy
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._errors = []
+        self.n_submitted = 0
+        self.n_dropped = 0
+        self._workers = [threading.Thread(target=self._run, daemon=True,
+                                          name='AsyncFrameWriter-%d' % i)
+                         for i in range(n_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                self._save_fn(*item)
+            except Exception as err:
+                self._errors.append(err)
+
+    def submit(self, target, frame):
+        """ Queue a frame for writing
+
+        Returns:
+            False if the frame was dropped because the queue was full
+        """
+        if self._policy == 'block':
+            self._queue.put((target, frame))
+        else:
+            try:
+                self._queue.put_nowait((target, frame))
+            except queue.Full:
+                self.n_dropped += 1
+                return False
+        self.n_submitted += 1
+        return True
+
+    def close(self):
+        """ Write all pending frames and stop the workers """
+
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        for err in self._errors:
+            print('ERROR: failed to write frame:', err)
+        if self.n_dropped:
+            print('WARNING: %d of %d frames dropped by the frame writer' % (
+                self.n_dropped, self.n_submitted + self.n_dropped))
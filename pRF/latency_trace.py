@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Trigger-to-photon latency tracing.
+
+For every scanner trigger that changes the stimulus, three times are kept:
+    t_trigger  driver key-down time of the '5' (TriggerListener)
+    t_draw     when the next stimulus had been drawn into the back buffer
+    t_flip     time of its first flip, stamped by win.callOnFlip
+All three are in the core.getTime() timebase. summary() reports the
+median, 95th percentile and maximum of trigger->draw, draw->flip and
+trigger->flip, and how many onsets missed the deadline.
+
+The frame loop only sees a trigger once the flip it is blocked in returns,
+and then draws and flips again, so trigger->flip normally lies between one
+and two refresh periods. The default deadline is therefore two refreshes;
+an onset later than that lost a frame.
+"""
+
+import numpy as np
+from psychopy import core
+
+latency_dtype = np.dtype([('tr_index', np.int32), ('t_trigger', np.float64),
+                          ('t_draw', np.float64), ('t_flip', np.float64)])
+
+
+def _empty(n):
+    """ n records with all times missing """
+
+    recs = np.zeros(n, dtype=latency_dtype)
+    for name in ('t_trigger', 't_draw', 't_flip'):
+        recs[name] = np.nan
+    return recs
+
+
+class LatencyTracer(object):
+    def __init__(self, frame_dur, capacity=1024, deadline_frames=2):
+        """ Constructor
+
+        frame_dur: refresh period in seconds
+        capacity: triggers to preallocate, doubled if needed
+        deadline_frames: onsets later than this many refresh periods after
+            the trigger are counted as late
+        """
+        self.frame_dur = frame_dur
+        self.deadline = deadline_frames * frame_dur
+        self._records = _empty(capacity)
+        self._pending = None  # row waiting for its stimulus
+        self.n_triggers = 0
+
+    def trigger(self, tr_index, t_trigger):
+        """ A trigger arrived that the next drawn stimulus answers """
+
+        if self.n_triggers == len(self._records):
+            self._records = np.concatenate([self._records,
+                                            _empty(len(self._records))])
+        rec = self._records[self.n_triggers]
+        rec['tr_index'] = tr_index
+        rec['t_trigger'] = t_trigger
+        self._pending = self.n_triggers
+        self.n_triggers += 1
+
+    def stimulus_drawn(self, win):
+        """ Call once the stimulus answering the last trigger is drawn; its
+        flip time is taken on the next win.flip() """
+
+        if self._pending is None:
+            return
+        self._records[self._pending]['t_draw'] = core.getTime()
+        win.callOnFlip(self._flipped, self._pending)
+        self._pending = None
+
+    def _flipped(self, row):
+        self._records[row]['t_flip'] = core.getTime()
+
+    def records(self):
+        """ The traced triggers, oldest first """
+
+        return self._records[:self.n_triggers]
+
+    def summary(self):
+        """ Latency distribution in ms
+
+        Returns:
+            dict with n_traced, n_late (trigger->flip above the deadline) and
+            median/p95/max for trigger_to_draw, draw_to_flip and
+            trigger_to_flip
+        """
+        recs = self.records()
+        recs = recs[np.isfinite(recs['t_flip'])]
+        spans = {'trigger_to_draw': recs['t_draw'] - recs['t_trigger'],
+                 'draw_to_flip': recs['t_flip'] - recs['t_draw'],
+                 'trigger_to_flip': recs['t_flip'] - recs['t_trigger']}
+        result = {'n_traced': int(len(recs)),
+                  'n_late': int(np.sum(spans['trigger_to_flip'] >
+                                       self.deadline))}
+        for name, span in spans.items():
+            for stat, fn in [('median', np.median),
+                             ('p95', lambda x: np.percentile(x, 95)),
+                             ('max', np.max)]:
+                result[name + '_' + stat + '_ms'] = (
+                    float(fn(span) * 1000) if len(span) else float('nan'))
+        return result
+
+    def save(self, path):
+        """ Write one row per traced trigger to a CSV file """
+
+        recs = self.records()
+        np.savetxt(path, np.column_stack([recs[name]
+                                          for name in latency_dtype.names]),
+                   fmt=['%d', '%.6f', '%.6f', '%.6f'], delimiter=',',
+                   header=','.join(latency_dtype.names), comments='')
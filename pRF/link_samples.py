@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Background reader for EyeLink samples sent over the link.
+
+LinkSampleReader drains getNextData()/getFloatData() on a daemon thread at
+the tracker's sample rate and appends (time, gx, gy, pupil, flags) records
+to a SampleRing: a preallocated NumPy ring buffer with a single writer.
+Readers never lock: the writer fills the slots first and only then
+advances n_written, so every sample below n_written is complete until it is
+overwritten capacity samples later. Consumers take zero-copy views with
+segments()/latest() and can check with oldest() that a range is still in
+the ring. Optionally every sample is also written to a memory-mapped .npy
+file for the whole run (rows past n_written stay zero).
+
+pylink is not thread safe: the reader holds its lock while it drains the
+link, and other threads must hold the same lock for their tracker calls.
+
+Gaps in the sample clock larger than 1.5 sample periods are counted in
+n_gaps; with a drained link there are none.
+
+Run this file to benchmark the reader against a simulated tracker:
+    python link_samples.py [rate_hz] [seconds]
+"""
+
+import sys
+import time
+import threading
+import numpy as np
+
+try:
+    import pylink
+    SAMPLE_TYPE = pylink.SAMPLE_TYPE
+    MISSING_DATA = pylink.MISSING_DATA
+except ImportError:  # the simulated tracker needs no pylink
+    SAMPLE_TYPE = 200
+    MISSING_DATA = -32768
+
+sample_dtype = np.dtype([('time', np.float64), ('gx', np.float32),
+                         ('gy', np.float32), ('pupil', np.float32),
+                         ('flags', np.uint16)])
+
+# flags
+LEFT_EYE = 1
+RIGHT_EYE = 2
+MISSING = 4  # no gaze, e.g. during a blink
+
+
+class SampleRing(object):
+    def __init__(self, capacity=1 << 16, spill_path=None, spill_capacity=0):
+        """ Constructor
+
+        capacity: samples kept in memory
+        spill_path: .npy file that receives every sample, memory-mapped
+        spill_capacity: samples preallocated in the spill file; samples
+            beyond it are counted in n_spill_lost
+        """
+        self.capacity = capacity
+        self.buffer = np.zeros(capacity, dtype=sample_dtype)
+        self.n_written = 0
+        self.spill = None
+        self.n_spill_lost = 0
+        if spill_path is not None:
+            self.spill = np.lib.format.open_memmap(
+                spill_path, mode='w+', dtype=sample_dtype,
+                shape=(spill_capacity,))
+
+    def extend(self, samples):
+        """ Append a block of samples (writer thread only) """
+
+        n = len(samples)
+        if self.spill is not None:
+            stop = min(self.n_written + n, len(self.spill))
+            kept = max(0, stop - self.n_written)
+            self.spill[self.n_written:self.n_written + kept] = samples[:kept]
+            self.n_spill_lost += n - kept
+        # only the last capacity samples of an oversized block survive
+        ring_start = self.n_written + max(0, n - self.capacity)
+        samples = samples[max(0, n - self.capacity):]
+        start = ring_start % self.capacity
+        first = min(len(samples), self.capacity - start)
+        self.buffer[start:start + first] = samples[:first]
+        self.buffer[:len(samples) - first] = samples[first:]
+        # publish only once the slots are filled
+        self.n_written += n
+
+    def oldest(self):
+        """ Index of the oldest sample still in the ring """
+
+        return max(0, self.n_written - self.capacity)
+
+    def segments(self, start, stop=None):
+        """ Zero-copy views of samples start..stop (absolute indices), one
+        or two arrays depending on the wrap-around """
+
+        if stop is None:
+            stop = self.n_written
+        start = max(start, stop - self.capacity, 0)
+        if start >= stop:
+            return [self.buffer[:0]]
+        i, j = start % self.capacity, stop % self.capacity
+        if i < j or j == 0:
+            return [self.buffer[i:j or self.capacity]]
+        return [self.buffer[i:], self.buffer[:j]]
+
+    def latest(self, n):
+        """ The last n samples; a view unless they wrap around """
+
+        segments = self.segments(self.n_written - n)
+        if len(segments) == 1:
+            return segments[0]
+        return np.concatenate(segments)
+
+    def flush(self):
+        """ Write the spill file to disk """
+
+        if self.spill is not None:
+            self.spill.flush()
+
+
+class LinkSampleReader(object):
+    def __init__(self, tracker, ring, sample_rate=1000, poll_interval=0.001,
+                 batch_size=256, lock=None):
+        """ Constructor
+
+        tracker: pylink.EyeLink, recording with samples over the link
+        ring: SampleRing to fill
+        sample_rate: tracker sample rate in Hz, for gap detection
+        poll_interval: sleep when the link queue is empty, in seconds
+        batch_size: samples decoded before they are published to the ring
+        lock: held while the link is drained; pylink is not thread safe,
+            so other threads hold it around their own tracker calls
+        """
+        self._tracker = tracker
+        self._lock = lock if lock is not None else threading.Lock()
+        self.ring = ring
+        self._period_ms = 1000.0 / sample_rate
+        self._poll_interval = poll_interval
+        self._batch = np.zeros(batch_size, dtype=sample_dtype)
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_time = None
+        self.n_gaps = 0
+        self.n_missing = 0
+
+    def start(self):
+        """ Start draining the link """
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='LinkSampleReader')
+        self._thread.start()
+
+    def stop(self):
+        """ Drain what is left, stop the thread and flush the spill file """
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.ring.flush()
+
+    def _decode(self, sample, rec):
+        if sample.isLeftSample():
+            eye, flags = sample.getLeftEye(), LEFT_EYE
+        else:
+            eye, flags = sample.getRightEye(), RIGHT_EYE
+        gx, gy = eye.getGaze()
+        rec['time'] = sample.getTime()
+        if gx == MISSING_DATA or gy == MISSING_DATA:
+            rec['gx'] = rec['gy'] = np.nan
+            flags |= MISSING
+            self.n_missing += 1
+        else:
+            rec['gx'] = gx
+            rec['gy'] = gy
+        rec['pupil'] = eye.getPupilSize()
+        rec['flags'] = flags
+
+    def _publish(self, n):
+        block = self._batch[:n]
+        times = block['time']
+        if self._last_time is not None:
+            times = np.concatenate([[self._last_time], times])
+        self.n_gaps += int(np.sum(np.diff(times) > 1.5 * self._period_ms))
+        self._last_time = block['time'][-1]
+        self.ring.extend(block)
+
+    def _drain(self):
+        """ Read everything queued on the link
+
+        Returns:
+            number of samples read
+        """
+        n = total = 0
+        while True:
+            data_type = self._tracker.getNextData()
+            if not data_type:
+                break
+            if data_type != SAMPLE_TYPE:
+                continue
+            self._decode(self._tracker.getFloatData(), self._batch[n])
+            n += 1
+            if n == len(self._batch):
+                self._publish(n)
+                total += n
+                n = 0
+        if n:
+            self._publish(n)
+            total += n
+        return total
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._lock:
+                n = self._drain()
+            if not n:
+                self._stop.wait(self._poll_interval)
+        with self._lock:
+            self._drain()
+
+
+class _SimEye(object):
+    def __init__(self, gx, gy, pupil):
+        self._gaze = (gx, gy)
+        self._pupil = pupil
+
+    def getGaze(self):
+        return self._gaze
+
+    def getPupilSize(self):
+        return self._pupil
+
+
+class _SimSample(object):
+    def __init__(self, t, gx, gy, pupil):
+        self._t = t
+        self._eye = _SimEye(gx, gy, pupil)
+
+    def getTime(self):
+        return self._t
+
+    def isLeftSample(self):
+        return True
+
+    def getLeftEye(self):
+        return self._eye
+
+    def getRightEye(self):
+        return None
+
+
+class SimulatedTracker(object):
+    """ Stand-in for pylink.EyeLink streaming synthetic samples in real
+    time: every getNextData() reports the samples due since the start;
+    every 500th sample is a blink (missing gaze) """
+
+    def __init__(self, sample_rate=2000):
+        self._period = 1.0 / sample_rate
+        self._t0 = time.perf_counter()
+        self.n_sent = 0
+        self._stopped_at = None
+
+    def stop(self):
+        """ Stop producing samples """
+
+        self._stopped_at = time.perf_counter()
+
+    def getNextData(self):
+        now = self._stopped_at or time.perf_counter()
+        if (now - self._t0) / self._period >= self.n_sent + 1:
+            return SAMPLE_TYPE
+        return 0
+
+    def getFloatData(self):
+        i = self.n_sent
+        self.n_sent += 1
+        if i % 500 == 499:
+            return _SimSample(i * self._period * 1000, MISSING_DATA,
+                              MISSING_DATA, 0.0)
+        phase = i * self._period * 2 * np.pi
+        return _SimSample(i * self._period * 1000,
+                          960 + 100 * np.cos(phase), 540 + 100 * np.sin(phase),
+                          1000.0)
+
+
+def main():
+    rate = float(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+    tracker = SimulatedTracker(rate)
+    ring = SampleRing(capacity=1 << 14)
+    reader = LinkSampleReader(tracker, ring, sample_rate=rate)
+    reader.start()
+    max_lag = 0
+    t_end = time.perf_counter() + seconds
+    while time.perf_counter() < t_end:
+        # a consumer peeking at the latest gaze, as the stimulus loop would
+        time.sleep(1 / 60.0)
+        if ring.n_written:
+            ring.latest(1)
+        max_lag = max(max_lag, tracker.n_sent - ring.n_written)
+    tracker.stop()
+    reader.stop()
+    times = ring.latest(min(ring.n_written, ring.capacity))['time']
+    print('%d samples sent, %d received at %.0f Hz (%.0f samples/s), '
+          '%d gaps, %d blinks, largest backlog %d samples' % (
+              tracker.n_sent, ring.n_written, rate, ring.n_written / seconds,
+              reader.n_gaps, reader.n_missing, max_lag))
+    print('ring holds consecutive samples: %s' % bool(
+        np.allclose(np.diff(times), 1000.0 / rate)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Region-of-interest frame capture for the pRF aperture.
+
+Instead of reading back the whole fullscreen framebuffer, only the bounding
+box of the circular aperture is read. Where pixel-buffer objects are
+available the read is asynchronous: grab() starts a DMA transfer into one of
+two PBOs and returns the frame issued by the previous grab() (a TR earlier,
+so the transfer has long finished), which avoids stalling on the GPU.
+Frames can optionally be downsampled to a target grid on capture.
+
+All calls must come from the thread that owns the window's GL context.
+"""
+
+import ctypes
+import numpy as np
+import pyglet.gl as GL
+from PIL import Image
+from psychopy.tools.monitorunittools import deg2pix
+
+
+def downsample(frame, size):
+    """ Box-filter an (h, w, 3) uint8 frame down to (size, size, 3) """
+
+    return np.asarray(Image.fromarray(frame).resize((size, size), Image.BOX))
+
+
+class RoiFrameGrabber(object):
+    def __init__(self, win, radius_deg, target_size=None, use_pbo=True):
+        """ Constructor
+
+        win: the PsychoPy window, aperture centred on the screen
+        radius_deg: radius of the aperture in degrees
+        target_size: downsample captured frames to target_size^2 pixels,
+            None keeps the native resolution
+        use_pbo: read asynchronously through pixel-buffer objects if the
+            driver supports them
+        """
+        # psychopy 'pix' units may differ from framebuffer pixels (retina)
+        win_w, win_h = win.size
+        fb_w, fb_h = getattr(win, 'frameBufferSize', win.size)
+        scale = float(fb_w) / win_w
+        r_pix = int(np.ceil(deg2pix(radius_deg, win.monitor) * scale))
+        x0 = max(0, int(fb_w) // 2 - r_pix)
+        y0 = max(0, int(fb_h) // 2 - r_pix)
+        x1 = min(int(fb_w), int(fb_w) // 2 + r_pix)
+        y1 = min(int(fb_h), int(fb_h) // 2 + r_pix)
+        self.roi = (x0, y0, x1 - x0, y1 - y0)  # GL coords, origin bottom-left
+        self._nbytes = self.roi[2] * self.roi[3] * 4
+        self._target_size = target_size
+
+        self._pbos = None
+        if use_pbo and GL.gl_info.have_extension('GL_ARB_pixel_buffer_object'):
+            self._pbos = (GL.GLuint * 2)()
+            GL.glGenBuffers(2, self._pbos)
+            for pbo in self._pbos:
+                GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, pbo)
+                GL.glBufferData(GL.GL_PIXEL_PACK_BUFFER, self._nbytes, None,
+                                GL.GL_STREAM_READ)
+            GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, 0)
+        self._pending = [None, None]  # tag of the read in flight per PBO
+        self._next = 0
+
+    def _read_pixels(self, dest):
+        x, y, w, h = self.roi
+        # psychopy reads the back buffer by default, leave it as it was
+        read_buffer = GL.GLint()
+        GL.glGetIntegerv(GL.GL_READ_BUFFER, ctypes.byref(read_buffer))
+        GL.glReadBuffer(GL.GL_FRONT)
+        GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 1)
+        GL.glReadPixels(x, y, w, h, GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, dest)
+        GL.glReadBuffer(read_buffer.value)
+
+    def _to_frame(self, data):
+        """ RGBA rows bottom-up -> (h, w, 3) top-down, downsampled """
+
+        frame = np.frombuffer(data, dtype=np.uint8).reshape(
+            self.roi[3], self.roi[2], 4)[::-1, :, :3]
+        frame = np.ascontiguousarray(frame)
+        if self._target_size is not None:
+            frame = downsample(frame, self._target_size)
+        return frame
+
+    def _collect(self, i):
+        """ Map PBO i and return (tag, frame) of the read issued into it """
+
+        tag = self._pending[i]
+        self._pending[i] = None
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, self._pbos[i])
+        ptr = GL.glMapBuffer(GL.GL_PIXEL_PACK_BUFFER, GL.GL_READ_ONLY)
+        data = ctypes.cast(ptr, ctypes.POINTER(
+            ctypes.c_ubyte * self._nbytes)).contents
+        frame = self._to_frame(bytes(data))
+        GL.glUnmapBuffer(GL.GL_PIXEL_PACK_BUFFER)
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, 0)
+        return tag, frame
+
+    def grab(self, tag):
+        """ Capture the aperture region of the front buffer
+
+        tag: returned together with the frame, e.g. the target file name
+
+        Returns:
+            list of (tag, frame) pairs that are complete; with PBOs this is
+            the previous grab, without PBOs this grab
+        """
+        if self._pbos is None:
+            data = (GL.GLubyte * self._nbytes)()
+            self._read_pixels(data)
+            return [(tag, self._to_frame(data))]
+
+        i = self._next
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, self._pbos[i])
+        self._read_pixels(0)  # offset into the bound PBO, returns at once
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, 0)
+        self._pending[i] = tag
+        self._next = 1 - i
+
+        done = []
+        if self._pending[1 - i] is not None:
+            done.append(self._collect(1 - i))
+        return done
+
+    def flush(self):
+        """ Return the frames of all reads still in flight, oldest first """
+
+        done = []
+        for i in (self._next, 1 - self._next):
+            if self._pbos is not None and self._pending[i] is not None:
+                done.append(self._collect(i))
+        return done
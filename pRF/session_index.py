@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SQLite index of every session under the *_SubjData folders.
+
+Parses the run logs (*_SubjData/pRF/Logging/*.log), the stimulus schedules
+(Output/stim_schedule*.csv/.npy) and the per-run timing files written by
+bar.py (frame_timing, trigger_times, trigger_latency_summary, events) into
+one database, so QA questions become queries instead of greps, e.g.
+
+    SELECT participant, run, started FROM sessions WHERE n_triggers >= 601
+
+Tables:
+    sessions      one row per log file: participant, run, start time,
+                  display, mode, geometry, refresh rate, trigger and
+                  response counts, abort time, completed (NULL if the log
+                  cannot tell)
+    headers       every Key=Value line of every log
+    schedules     one row per schedule file
+    timing_files  one row per timing file, summary as JSON
+    files         path, mtime and size of every ingested file
+
+Files are parsed in a process pool. Ingest is incremental: a file whose
+mtime and size match the files table is not read again, and rows of files
+that disappeared are dropped.
+
+Usage:
+    python session_index.py [project_folder] [--db index.sqlite] [--jobs N]
+                            [--query SQL]
+"""
+
+import os
+import re
+import glob
+import json
+import sqlite3
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from display_profiles import load_profiles
+from stim_schedule import load_stim_schedule
+from frame_timing import FrameTimingRecorder
+from event_journal import load_journal
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, kind TEXT, mtime_ns INTEGER, size INTEGER);
+CREATE TABLE IF NOT EXISTS sessions (
+    log_path TEXT PRIMARY KEY, subject_folder TEXT, participant TEXT,
+    experiment TEXT, run INTEGER, started TEXT, display TEXT, mode TEXT,
+    distance_cm REAL, width_cm REAL, pix_w REAL, pix_h REAL,
+    refresh_rate REAL, frame_dur REAL, n_triggers INTEGER,
+    n_responses INTEGER, n_lines INTEGER, last_time REAL, abort_time REAL,
+    completed INTEGER);
+CREATE TABLE IF NOT EXISTS headers (
+    log_path TEXT, key TEXT, value TEXT);
+CREATE TABLE IF NOT EXISTS schedules (
+    path TEXT PRIMARY KEY, subject_folder TEXT, run INTEGER, n_trs INTEGER,
+    n_orientations INTEGER, n_fix_changes INTEGER);
+CREATE TABLE IF NOT EXISTS timing_files (
+    path TEXT PRIMARY KEY, subject_folder TEXT, kind TEXT, run INTEGER,
+    n_rows INTEGER, summary TEXT);
+CREATE INDEX IF NOT EXISTS sessions_participant ON sessions (participant, run);
+CREATE INDEX IF NOT EXISTS headers_path ON headers (log_path);
+'''
+
+# table and key column holding the rows of each kind of file
+TABLES = {'log': ('sessions', 'log_path'), 'schedule': ('schedules', 'path'),
+          'timing': ('timing_files', 'path')}
+
+LOG_NAME = re.compile(r'^(.+)_([^_]+)_Run(\d+)_(\d{4}-\d{2}-\d{2})_'
+                      r'(\d{2})h(\d{2})\.(\d{2}\.\d+)\.log$')
+LOG_LINE = re.compile(r'^\s*([\d.]+)\s*\t(\w+)\s*\t(.*)$')
+RUN = re.compile(r'Run(\d+)')
+TIMING_KINDS = ('frame_timing', 'trigger_times', 'trigger_latency_summary',
+                'trigger_latency', 'events')
+
+
+def _number(value):
+    """ float of a header value such as '128.7cm', None if not numeric """
+
+    match = re.match(r'^\s*([-+\d.eE]+)', value)
+    try:
+        return float(match.group(1)) if match else None
+    except ValueError:
+        return None
+
+
+def _run_of(path):
+    match = RUN.search(os.path.basename(path))
+    return int(match.group(1)) if match else None
+
+
+def _subject_folder(path):
+    """ The *_SubjData folder a file belongs to """
+
+    parts = os.path.normpath(path).split(os.sep)
+    folders = [p for p in parts if p.endswith('_SubjData')]
+    return folders[-1] if folders else None
+
+
+def _display_of(distance_cm, width_cm, profiles):
+    """ Name of the display profile with this geometry, for logs written
+    before the display was logged """
+
+    for name, profile in profiles.items():
+        if distance_cm is not None and width_cm is not None and \
+                abs(profile['distance_cm'] - distance_cm) < 1e-6 and \
+                abs(profile['width_cm'] - width_cm) < 1e-6:
+            return name
+    return None
+
+
+def parse_log(path, profiles):
+    """ Session row and header rows of one run log """
+
+    headers = []
+    n_triggers = n_responses = n_lines = 0
+    last_time = abort_time = None
+    with open(path, errors='replace') as f:
+        for line in f:
+            n_lines += 1
+            match = LOG_LINE.match(line)
+            if match is None:
+                key, sep, value = line.strip().partition('=')
+                if sep and key and ' ' not in key:
+                    headers.append((path, key, value))
+                continue
+            t, msg = float(match.group(1)), match.group(3).strip()
+            last_time = t
+            if msg == 'Keypress: 5':
+                n_triggers += 1
+            elif msg == 'Keypress: 1':
+                n_responses += 1
+            elif msg == 'Keypress: escape' and abort_time is None:
+                abort_time = t
+
+    values = dict((key, value) for _, key, value in headers)
+    session = {'log_path': path, 'subject_folder': _subject_folder(path),
+               'participant': None, 'experiment': None, 'run': None,
+               'started': None, 'n_lines': n_lines, 'last_time': last_time,
+               'n_responses': n_responses, 'mode': values.get('Mode')}
+    match = LOG_NAME.match(os.path.basename(path))
+    if match:
+        session['participant'] = match.group(1)
+        session['experiment'] = match.group(2)
+        session['run'] = int(match.group(3))
+        session['started'] = '%sT%s:%s:%s' % match.group(4, 5, 6, 7)
+    for column, key in [('distance_cm', 'MonitorDistance'),
+                        ('width_cm', 'MonitorWidth'),
+                        ('pix_w', 'PixelWidth'), ('pix_h', 'PixelHeight'),
+                        ('refresh_rate', 'RefreshRate'),
+                        ('frame_dur', 'FrameDuration')]:
+        session[column] = _number(values.get(key, ''))
+    session['display'] = values.get('Display') or _display_of(
+        session['distance_cm'], session['width_cm'], profiles)
+    # runs with the trigger listener log the count, older ones each key
+    if 'Triggers' in values:
+        n_triggers = int(_number(values['Triggers']))
+    session['n_triggers'] = n_triggers
+    if 'AbortTime' in values:
+        abort_time = _number(values['AbortTime'])
+    session['abort_time'] = abort_time
+    if values.get('RunCompleted') == 'True':
+        session['completed'] = 1
+    elif values.get('RunCompleted') == 'False' or abort_time is not None:
+        session['completed'] = 0
+    else:
+        session['completed'] = None
+    return session, headers
+
+
+def parse_schedule(path):
+    """ Schedule row of one stim_schedule file """
+
+    schedule = load_stim_schedule(path, mmap=False)
+    return {'path': path, 'subject_folder': _subject_folder(path),
+            'run': _run_of(path), 'n_trs': int(len(schedule)),
+            'n_orientations': int(len(np.unique(schedule['orientation']))),
+            'n_fix_changes': int(np.sum(schedule['fix_change']))}
+
+
+def parse_timing(path, kind):
+    """ Timing-file row: number of records and a summary """
+
+    summary = None
+    if kind == 'frame_timing':
+        timing = FrameTimingRecorder.from_file(path)
+        n_rows = timing.n_frames
+        summary = timing.summary()
+    elif kind == 'trigger_latency_summary':
+        with open(path) as f:
+            summary = json.load(f)
+        n_rows = summary.get('n_traced')
+    elif kind == 'events':
+        records, event_types = load_journal(path)
+        n_rows = len(records)
+        counts = np.bincount(records['event'], minlength=len(event_types))
+        summary = dict(zip(event_types, [int(n) for n in counts]))
+    else:  # one-header CSVs: trigger_times, trigger_latency
+        with open(path) as f:
+            n_rows = max(0, sum(1 for line in f if line.strip()) - 1)
+    return {'path': path, 'subject_folder': _subject_folder(path),
+            'kind': kind, 'run': _run_of(path), 'n_rows': n_rows,
+            'summary': json.dumps(summary) if summary is not None else None}
+
+
+def parse_file(item):
+    """ Parse one file in a worker process
+
+    item: (path, kind, profiles)
+
+    Returns:
+        (path, kind, row, header rows) or (path, kind, None, error message)
+    """
+    path, kind, profiles = item
+    try:
+        if kind == 'log':
+            row, headers = parse_log(path, profiles)
+            return path, kind, row, headers
+        if kind == 'schedule':
+            return path, kind, parse_schedule(path), []
+        timing_kind = next(k for k in TIMING_KINDS
+                           if os.path.basename(path).startswith(k))
+        return path, kind, parse_timing(path, timing_kind), []
+    except Exception as err:
+        return path, kind, None, str(err)
+
+
+def find_files(root):
+    """ (path, kind) of every file the index covers """
+
+    files = []
+    for data_folder in sorted(glob.glob(os.path.join(root, '*_SubjData',
+                                                     '*'))):
+        for path in sorted(glob.glob(os.path.join(data_folder, 'Logging',
+                                                  '*.log'))):
+            files.append((path, 'log'))
+        output = os.path.join(data_folder, 'Output')
+        for path in sorted(glob.glob(os.path.join(output,
+                                                  'stim_schedule*.csv')) +
+                           glob.glob(os.path.join(output,
+                                                  'stim_schedule*.npy'))):
+            files.append((path, 'schedule'))
+        for pattern in ['frame_timing_Run*.npy', 'trigger_times_Run*.csv',
+                        'trigger_latency_Run*.csv',
+                        'trigger_latency_summary_Run*.json',
+                        'events_Run*.bin']:
+            for path in sorted(glob.glob(os.path.join(output, pattern))):
+                files.append((path, 'timing'))
+    return files
+
+
+def _delete(db, path, kind):
+    table, key = TABLES[kind]
+    db.execute('DELETE FROM %s WHERE %s = ?' % (table, key), (path,))
+    if kind == 'log':
+        db.execute('DELETE FROM headers WHERE log_path = ?', (path,))
+    db.execute('DELETE FROM files WHERE path = ?', (path,))
+
+
+def _insert(db, table, row):
+    columns = sorted(row)
+    db.execute('INSERT INTO %s (%s) VALUES (%s)' % (
+        table, ', '.join(columns), ', '.join('?' * len(columns))),
+        [row[c] for c in columns])
+
+
+def update_index(root, db_path, pool):
+    """ Bring the index at db_path up to date with the files under root
+
+    Returns:
+        (files parsed, files unchanged, files removed)
+    """
+    db = sqlite3.connect(db_path)
+    db.executescript(SCHEMA)
+    known = dict((path, (kind, mtime, size)) for path, kind, mtime, size in
+                 db.execute('SELECT path, kind, mtime_ns, size FROM files'))
+
+    todo = []
+    present = set()
+    for path, kind in find_files(root):
+        present.add(path)
+        st = os.stat(path)
+        if known.get(path) != (kind, st.st_mtime_ns, st.st_size):
+            todo.append((path, kind, st))
+
+    profiles = load_profiles()
+    items = [(path, kind, profiles) for path, kind, _ in todo]
+    results = pool.map(parse_file, items, chunksize=8)
+    with db:
+        for (path, kind, st), (_, _, row, extra) in zip(todo, results):
+            _delete(db, path, kind)
+            if row is None:
+                print('WARNING: could not parse %s: %s' % (path, extra))
+                continue
+            _insert(db, TABLES[kind][0], row)
+            if kind == 'log':
+                db.executemany('INSERT INTO headers VALUES (?, ?, ?)', extra)
+            db.execute('INSERT INTO files VALUES (?, ?, ?, ?)',
+                       (path, kind, st.st_mtime_ns, st.st_size))
+        removed = [(path, kind) for path, (kind, _, _) in known.items()
+                   if path not in present]
+        for path, kind in removed:
+            _delete(db, path, kind)
+    db.close()
+    return len(todo), len(present) - len(todo), len(removed)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Index the run logs, schedules and timing files')
+    parser.add_argument('root', nargs='?',
+                        default=os.path.dirname(os.path.dirname(
+                            os.path.abspath(__file__))),
+                        help='folder holding the *_SubjData folders')
+    parser.add_argument('--db', default=None,
+                        help='index file (default: <root>/session_index.sqlite)')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='worker processes (default: all cores)')
+    parser.add_argument('--query', default=None,
+                        help='SQL to run on the updated index')
+    args = parser.parse_args()
+
+    db_path = args.db or os.path.join(args.root, 'session_index.sqlite')
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        parsed, unchanged, removed = update_index(args.root, db_path, pool)
+    print('%s: %d files parsed, %d unchanged, %d removed' % (
+        db_path, parsed, unchanged, removed))
+
+    if args.query:
+        db = sqlite3.connect(db_path)
+        cursor = db.execute(args.query)
+        print('\t'.join(col[0] for col in cursor.description))
+        for row in cursor:
+            print('\t'.join(str(value) for value in row))
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stimulus schedule compiler for the pRF bar sweeps.
+
+Builds the sweep schedule of one or more runs as a NumPy structured array
+(one record per bar TR). Every run draws its step order from its own
+np.random.Generator seeded with (seed, run), so a run's schedule does not
+depend on which other runs are built with it. Compiled schedules are cached
+on disk, keyed by a hash of the parameters.
+
+Schedules are stored as typed .npy files (memory-mappable, no parsing on
+load) next to a CSV with the same numeric columns. load_stim_schedule() also
+reads the older stim_schedule.csv files with a "(x, y)" position column.
+"""
+
+import os
+import re
+import ast
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+# bump when the layout or the generation procedure changes
+SCHEDULE_VERSION = 2
+
+n_lead_trs = 10         # fixation TRs before the first bar
+n_tail_trs = 15         # fixation TRs after the last bar
+
+schedule_dtype = np.dtype([
+    ('run', 'i4'),
+    ('rep', 'i4'),
+    ('orientation', 'f8'),
+    ('step', 'i4'),
+    ('tr_index', 'i4'),
+    ('pos_x', 'f8'),
+    ('pos_y', 'f8'),
+    ('fix_change', 'i4'),
+    ])
+
+_thisDir = os.path.dirname(os.path.abspath(__file__))
+default_cache_dir = os.path.join(_thisDir, 'schedule_cache')
+
+
+def sweep_directions(orientations):
+    """ Unit vectors along which bars of the given orientations sweep
+
+    Returns:
+        (n, 2) array of (dx, dy)
+    """
+    orientations = np.asarray(orientations, dtype=float)
+    angle_rad = np.deg2rad(orientations - 90)
+    dx = np.cos(angle_rad)
+    dy = np.sin(angle_rad)
+    # oblique bars sweep mirrored, as in the original schedule
+    dx[np.isin(orientations, [45, 135])] *= -1
+    norm = np.sqrt(dx**2 + dy**2)
+    directions = np.column_stack([dx / norm, dy / norm])
+    return _snap_zero(directions)
+
+
+def _snap_zero(values, tol=1e-9):
+    """ Replace floating point noise such as 1.9e-16 by an exact 0"""
+
+    values = np.asarray(values, dtype=float)
+    return np.where(np.abs(values) < tol, 0.0, values)
+
+
+def _build_run(run, orientations, n_steps, n_reps, aperture_radius, seed,
+               counterbalance):
+    """ Compile the schedule of a single run"""
+
+    rng = np.random.default_rng([seed, run])
+
+    # Counterbalance the orientation order across runs (cyclic Latin square)
+    if counterbalance:
+        orientations = np.roll(orientations, -(run - 1))
+    n_ori = len(orientations)
+
+    # one freshly shuffled offset list for each rep x ori sweep
+    base_offsets = np.linspace(-aperture_radius, aperture_radius, n_steps)
+    offsets = rng.permuted(np.tile(base_offsets, (n_reps * n_ori, 1)), axis=1)
+
+    directions = np.tile(sweep_directions(orientations), (n_reps, 1))
+    positions = offsets[:, :, np.newaxis] * directions[:, np.newaxis, :]
+
+    schedule = np.zeros(n_reps * n_ori * n_steps, dtype=schedule_dtype)
+    schedule['run'] = run
+    schedule['rep'] = np.repeat(np.arange(1, n_reps + 1), n_ori * n_steps)
+    schedule['orientation'] = np.tile(np.repeat(orientations, n_steps), n_reps)
+    schedule['step'] = np.tile(np.arange(1, n_steps + 1), n_reps * n_ori)
+    schedule['tr_index'] = n_lead_trs + np.arange(len(schedule))
+    schedule['pos_x'] = _snap_zero(positions[:, :, 0].ravel())
+    schedule['pos_y'] = _snap_zero(positions[:, :, 1].ravel())
+    return schedule
+
+
+def build_stim_schedule(runs=1, orientations=(0, 45, 90, 135), n_steps=12,
+                        n_reps=12, aperture_radius=5.0, seed=42,
+                        counterbalance=True, cache_dir=default_cache_dir):
+    """
+    Build the bar-sweep schedule of one or more runs.
+
+    Args:
+        runs: run number, or an iterable of run numbers (1-based)
+        orientations: bar orientations in degrees
+        n_steps: bar positions per sweep, evenly spaced across the aperture
+        n_reps: repetitions of the full orientation set
+        aperture_radius: radius of the aperture in degrees
+        seed: base seed; each run uses np.random.default_rng([seed, run])
+        counterbalance: rotate the orientation order from run to run
+        cache_dir: folder for compiled schedules, None disables caching
+
+    Returns:
+        structured array with schedule_dtype, ordered by run and time
+    """
+    runs = [int(runs)] if np.isscalar(runs) else [int(r) for r in runs]
+    params = {
+        'version': SCHEDULE_VERSION,
+        'runs': runs,
+        'orientations': [float(o) for o in orientations],
+        'n_steps': int(n_steps),
+        'n_reps': int(n_reps),
+        'aperture_radius': float(aperture_radius),
+        'seed': int(seed),
+        'counterbalance': bool(counterbalance),
+        }
+
+    cache_file = None
+    if cache_dir is not None:
+        key = hashlib.sha1(json.dumps(params, sort_keys=True).encode())
+        cache_file = os.path.join(cache_dir, key.hexdigest() + '.npy')
+        if os.path.exists(cache_file):
+            return np.load(cache_file)
+
+    schedule = np.concatenate([
+        _build_run(run, np.asarray(params['orientations']), n_steps, n_reps,
+                   aperture_radius, seed, counterbalance)
+        for run in runs])
+
+    if cache_file is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # write then rename, so concurrent launches never read a partial file
+        tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            np.save(f, schedule)
+        os.replace(tmp_file, cache_file)
+    return schedule
+
+
+def save_stim_schedule(path, schedule):
+    """
+    Save a schedule as <path>.npy plus a CSV with the same numeric columns.
+
+    Args:
+        path: output file name without extension
+        schedule: structured array with schedule_dtype
+    """
+    path = os.path.splitext(path)[0]
+    schedule = np.asarray(schedule, dtype=schedule_dtype)
+    np.save(path + '.npy', schedule)
+    pd.DataFrame(schedule).to_csv(path + '.csv', index=False)
+
+
+def _run_from_filename(path):
+    """ Run number encoded in a file name such as stim_schedule_Run02.csv,
+    schedules from before runs were tagged are taken as run 1"""
+
+    match = re.search(r'Run(\d+)', os.path.basename(path))
+    return int(match.group(1)) if match else 1
+
+
+def load_stim_schedule(path, mmap=True):
+    """
+    Load a schedule saved by bar.py.
+
+    Args:
+        path: a .npy schedule, a CSV with pos_x/pos_y columns, or a legacy
+            stim_schedule.csv with a "(x, y)" position column
+        mmap: memory-map .npy files instead of reading them into memory
+
+    Returns:
+        structured array with schedule_dtype
+    """
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r' if mmap else None)
+
+    df = pd.read_csv(path, float_precision='round_trip')
+    schedule = np.zeros(len(df), dtype=schedule_dtype)
+    if 'position' in df:
+        positions = np.array([ast.literal_eval(p) for p in df['position']],
+                             dtype=float).reshape(-1, 2)
+        df['pos_x'] = _snap_zero(positions[:, 0])
+        df['pos_y'] = _snap_zero(positions[:, 1])
+    if 'run' not in df:
+        df['run'] = _run_from_filename(path)
+    if 'tr_index' not in df:
+        df['tr_index'] = n_lead_trs + np.arange(len(df))
+    for name in schedule_dtype.names:
+        if name in df:
+            schedule[name] = df[name].to_numpy()
+    return schedule
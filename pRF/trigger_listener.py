@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Background listener for scanner triggers and participant responses.
+
+A daemon thread drains the psychtoolbox keyboard queue (the same backend as
+EyeLinkCoreGraphicsPsychoPy._kb) and pushes every key of interest, stamped
+with the driver-level key-down time, onto a queue. The frame loop drains the
+queue once per flip; waits block on it instead of polling event.getKeys().
+
+Timestamps are in the psychtoolbox GetSecs timebase, i.e. comparable with
+core.getTime(). They are taken by the driver, so the poll interval does not
+affect them, only how soon an event reaches the queue. The thread polls
+every 2 ms by default: on average a key arrives 1 ms after the driver saw
+it, so about 6% of the triggers at 60 Hz are picked up one flip later than
+with an instant wake-up, while the thread only takes the GIL 500 times a
+second. Shorter intervals cut that latency at the cost of more CPU time and
+GIL contention with the frame loop.
+
+Keys read here no longer go through psychopy.event, so the log has no
+"Keypress: 5" lines; triggers are in trigger_times and the event journal.
+
+Note: psychopy keyboards share one key buffer per device, so only start the
+listener after the tracker setup has stopped reading the keyboard.
+"""
+
+import queue
+import threading
+import collections
+from psychopy.hardware import keyboard
+
+TriggerEvent = collections.namedtuple('TriggerEvent', ['key', 't_down'])
+
+
+class TriggerListener(object):
+    def __init__(self, keys=('5', '1', 'escape'), trigger_key='5',
+                 poll_interval=0.002):
+        """ Constructor
+
+        keys: key names to listen for
+        trigger_key: key sent by the scanner, its times are kept in
+            trigger_times
+        poll_interval: sleep between drains of the driver queue, in
+            seconds; see the module docstring for the trade-off
+        """
+        self._keys = list(keys)
+        self._trigger_key = trigger_key
+        self._poll_interval = poll_interval
+        self._kb = keyboard.Keyboard(backend='ptb')
+        self._events = queue.SimpleQueue()
+        self._stop = threading.Event()
+        self._thread = None
+        # key-down times of every scanner trigger seen, in order
+        self.trigger_times = []
+
+    def start(self):
+        """ Discard old key presses and start listening """
+
+        self._kb.clearEvents()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='TriggerListener', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the listener thread """
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            for key in self._kb.getKeys(keyList=self._keys,
+                                        waitRelease=False, clear=True):
+                if key.name == self._trigger_key:
+                    self.trigger_times.append(key.tDown)
+                self._events.put(TriggerEvent(key.name, key.tDown))
+            self._stop.wait(self._poll_interval)
+
+    def drain(self):
+        """ Return all events received since the last call, oldest first """
+
+        events = []
+        while True:
+            try:
+                events.append(self._events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def wait_for(self, keys, timeout=None):
+        """ Block until one of keys arrives; other events are discarded
+
+        Returns:
+            the TriggerEvent, or None if the timeout expired
+        """
+        while True:
+            try:
+                evt = self._events.get(timeout=timeout)
+            except queue.Empty:
+                return None
+            if evt.key in keys:
+                return evt